@@ -0,0 +1,221 @@
+from CalibrationContext import HestonCalibrationContext
+import VolatilityFunctions as vol
+import pyarrow.parquet as pq
+import pyarrow as pa
+import PricesFunctions as pr
+import Sensitivity
+import pandas as pd
+import numpy as np
+import argparse
+import json
+import time
+import sys
+import os
+
+# End-of-day revaluation without the Streamlit app. Positions (ticker, strike, maturity, type,
+# quantity) are streamed from CSV or Parquet in chunks, priced with the calibrated parameters of their
+# underlying and written out chunk by chunk, so memory does not grow with the portfolio.
+#
+#   python BatchPricing.py positions.csv parameters.csv --output prices.parquet --valuation-date 2023-09-12
+#
+# The parameter file (CSV, Parquet or JSON) has one row per ticker, or per ticker and maturity, with
+# v0, kappa, theta, sigma, rho, spot_price, risk_free_rate and dividend_yield.
+
+POSITION_COLUMNS = ['ticker', 'strike', 'maturity', 'type', 'quantity']
+PARAMETER_COLUMNS = ['v0', 'kappa', 'theta', 'sigma', 'rho', 'spot_price', 'risk_free_rate', 'dividend_yield']
+GREEK_COLUMNS = ['price', 'delta', 'gamma', 'vega_v0', 'vega_theta', 'kappa', 'sigma', 'rho']
+
+def read_table(path):
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path)
+    if path.endswith('.json'):
+        with open(path) as file:
+            data = json.load(file)
+        # {ticker: {v0: ..., ...}} or a list of records
+        return pd.DataFrame.from_dict(data, orient='index').rename_axis('ticker').reset_index() if isinstance(data, dict) else pd.DataFrame(data)
+    return pd.read_csv(path)
+
+def load_parameters(path_or_frame):
+    parameters = read_table(path_or_frame) if isinstance(path_or_frame, str) else path_or_frame.copy()
+    missing = [column for column in ['ticker'] + PARAMETER_COLUMNS if column not in parameters.columns]
+    if missing:
+        raise ValueError(f'Faltan columnas en el archivo de parámetros: {missing}')
+    parameters['ticker'] = parameters['ticker'].astype(str)
+    if 'maturity' in parameters.columns:
+        parameters['maturity'] = pd.to_datetime(parameters['maturity'])
+    return parameters
+
+def iter_positions(path, chunk_size=10000):
+    # Parquet is read by row batches, CSV by pandas chunks; either way at most chunk_size rows at a time
+    if path.endswith('.parquet'):
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, chunksize=chunk_size)
+
+def attach_parameters(positions, parameters):
+    # Parameters per (ticker, maturity) when the file has maturities, per ticker otherwise
+    missing = [column for column in POSITION_COLUMNS if column not in positions.columns]
+    if missing:
+        raise ValueError(f'Faltan columnas en el archivo de posiciones: {missing}')
+    positions = positions.copy()
+    positions['ticker'] = positions['ticker'].astype(str)
+    positions['maturity'] = pd.to_datetime(positions['maturity'])
+    keys = ['ticker', 'maturity'] if 'maturity' in parameters.columns else ['ticker']
+    merged = positions.merge(parameters[keys + PARAMETER_COLUMNS], on=keys, how='left', validate='many_to_one')
+    unknown = merged['v0'].isna()
+    if unknown.any():
+        raise ValueError(f'No hay parámetros calibrados para: {sorted(merged.loc[unknown, "ticker"].unique())}')
+    return merged
+
+def is_call(types):
+    types = pd.Series(types).astype(str).str.strip().str.upper()
+    if not types.isin(['CALL', 'PUT', 'C', 'P']).all():
+        raise ValueError("type debe ser 'Call', 'Put', 'C' o 'P'")
+    return types.str.startswith('C').values
+
+def price_array(positions, ttm, call_option, greeks=True, pricing_batch=1024):
+    # Vectorized prices and greeks per underlying and maturity, whose contracts share parameters, spot,
+    # rate and dividend: the characteristic function is evaluated once per group (and bumped scenario),
+    # and only the strikes of at most pricing_batch contracts at a time are priced against it. Without
+    # greeks only the price column is filled.
+    names = GREEK_COLUMNS if greeks else ['price']
+    results = {name: np.empty(len(positions)) for name in names}
+    groups = positions.groupby(['ticker', 'maturity'], sort=False).indices
+    for group_rows in groups.values():
+        first = positions.iloc[group_rows[0]]
+        shared = {name: float(first[name]) for name in ['v0', 'kappa', 'theta', 'sigma', 'rho', 'spot_price']}
+        rate, dividend = float(first['risk_free_rate']), float(first['dividend_yield'])
+        for start in range(0, len(group_rows), pricing_batch):
+            rows = group_rows[start:start + pricing_batch]
+            base = dict(shared, strike_price=positions['strike'].values[rows].astype(float), ttm=float(ttm[rows[0]]))
+            if greeks:
+                values = Sensitivity.heston_greeks(base, None, rate, dividend, call_option[rows])
+            else:
+                values = {'price': pr.HestonNPVArray(risk_free_rate=rate, dividend_yield=dividend, call_option=call_option[rows], **base)}
+            for name in names:
+                results[name][rows] = values[name]
+    return results
+
+def price_quantlib(positions, call_option, valuation_date, contexts, greeks=True):
+    # AnalyticHestonEngine prices, one context (term structures, process, model, engine) per underlying,
+    # maturity and option type, kept in contexts across chunks. The greeks are the central differences
+    # of Sensitivity.heston_greeks taken on QuantLib prices too (thirteen NPVs per contract); a bump the
+    # Heston model does not accept (e.g. kappa pushed to zero) leaves its greek as NaN.
+    names = GREEK_COLUMNS if greeks else ['price']
+    results = {name: np.empty(len(positions)) for name in names}
+    calculation_date = vol.to_ql_dates(valuation_date)
+    groups = positions.assign(call=call_option).groupby(['ticker', 'maturity', 'call'], sort=False).indices
+    for (ticker, maturity, call), rows in groups.items():
+        group = positions.iloc[rows]
+        first = group.iloc[0]
+        key = (ticker, maturity, call, *[float(first[name]) for name in ['spot_price', 'risk_free_rate', 'dividend_yield']])
+        if key not in contexts:
+            contexts[key] = HestonCalibrationContext(calculation_date, vol.to_ql_dates(maturity), float(first['spot_price']),
+                                                     float(first['dividend_yield']), float(first['risk_free_rate']), bool(call))
+        context = contexts[key]
+        params = first[['v0', 'kappa', 'theta', 'sigma', 'rho']].values.astype(float)
+        strikes = group['strike'].values.astype(float)
+        base_price = context.npvs(params, strikes)
+        if not greeks:
+            results['price'][rows] = base_price
+            continue
+
+        spot_price = float(first['spot_price'])
+        arguments = dict(zip(['v0', 'kappa', 'theta', 'sigma', 'rho'], params), spot_price=spot_price)
+
+        def reprice(name, shift):
+            try:
+                if name == 'spot_price':
+                    context.set_spot(spot_price + shift)
+                    return context.npvs(params, strikes)
+                bumped = params.copy()
+                bumped[['v0', 'kappa', 'theta', 'sigma', 'rho'].index(name)] += shift
+                return context.npvs(bumped, strikes)
+            except ValueError:
+                return np.full(len(strikes), np.nan)
+            finally:
+                context.set_spot(spot_price)
+
+        bumps = Sensitivity.greek_bumps(arguments)
+        shifted = {name: (reprice(name, bump), reprice(name, -bump)) for name, bump in bumps.items()}
+        values = Sensitivity.central_differences(base_price, shifted, bumps)
+        for name in names:
+            results[name][rows] = values[name]
+    return results
+
+def price_positions(positions, parameters, valuation_date, engine='array', contexts=None, greeks=True):
+    # Adds TTM, price, greeks and the position value and delta to one chunk of positions
+    valuation_date = pd.Timestamp(valuation_date).normalize()
+    positions = attach_parameters(positions, parameters)
+    ttm = (positions['maturity'] - valuation_date).dt.days.values / 365.0
+    call_option = is_call(positions['type'])
+    if engine == 'array':
+        results = price_array(positions, ttm, call_option, greeks)
+    elif engine == 'quantlib':
+        # Prices and greeks of live contracts come from QuantLib alone; expired ones are worth their
+        # intrinsic value, which the array pricer gives
+        live = ttm > 0
+        contexts = {} if contexts is None else contexts
+        results = {name: np.empty(len(positions)) for name in (GREEK_COLUMNS if greeks else ['price'])}
+        for rows, values in ((live, price_quantlib(positions[live], call_option[live], valuation_date, contexts, greeks)),
+                             (~live, price_array(positions[~live], ttm[~live], call_option[~live], greeks))):
+            for name in results:
+                results[name][rows] = values[name]
+    else:
+        raise ValueError("engine debe ser 'array' o 'quantlib'")
+    output = positions[POSITION_COLUMNS].copy()
+    output['ttm'] = ttm
+    for name in results:
+        output[name] = results[name]
+    output['market_value'] = output['price'] * output['quantity']
+    if greeks:
+        output['position_delta'] = output['delta'] * output['quantity']
+    return output
+
+def price_portfolio(positions_path, parameters, output_path, valuation_date, chunk_size=10000, engine='array', greeks=True, progress=None):
+    # Streams positions_path to output_path (Parquet, or CSV for any other extension) and returns the
+    # number of contracts, the elapsed seconds and the throughput
+    parameters = load_parameters(parameters)
+    contexts = {}
+    writer = None
+    contracts = 0
+    start = time.perf_counter()
+    if os.path.exists(output_path):
+        os.remove(output_path)
+    try:
+        for chunk in iter_positions(positions_path, chunk_size):
+            priced = price_positions(chunk, parameters, valuation_date, engine, contexts, greeks)
+            if output_path.endswith('.parquet'):
+                table = pa.Table.from_pandas(priced, preserve_index=False)
+                writer = pq.ParquetWriter(output_path, table.schema) if writer is None else writer
+                writer.write_table(table)
+            else:
+                priced.to_csv(output_path, mode='a', header=contracts == 0, index=False)
+            contracts += len(priced)
+            if progress is not None:
+                progress(contracts, time.perf_counter() - start)
+    finally:
+        if writer is not None:
+            writer.close()
+    seconds = time.perf_counter() - start
+    return {'contracts': contracts, 'seconds': seconds, 'contracts_per_second': contracts / seconds if seconds > 0 else np.inf}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Valuación Heston por lotes de un archivo de posiciones')
+    parser.add_argument('positions')
+    parser.add_argument('parameters')
+    parser.add_argument('--output', default='prices.parquet')
+    parser.add_argument('--valuation-date', default=pd.Timestamp.today().strftime('%Y-%m-%d'))
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    parser.add_argument('--engine', default='array', choices=['array', 'quantlib'])
+    parser.add_argument('--no-greeks', action='store_true')
+    args = parser.parse_args(argv)
+    summary = price_portfolio(args.positions, args.parameters, args.output, args.valuation_date, args.chunk_size, args.engine, not args.no_greeks,
+                              progress=lambda done, seconds: print(f'{done} contratos, {done / max(seconds, 1e-9):.0f} contratos/s'))
+    print(f'{summary["contracts"]} contratos valuados en {summary["seconds"]:.2f} s '
+          f'({summary["contracts_per_second"]:.0f} contratos/s) -> {args.output}')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
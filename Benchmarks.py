@@ -0,0 +1,182 @@
+from HestonVolatilities import HestonImpliedVolatility
+from CalibrationMetrics import CalibrationMetrics
+from MarketData import MarketDataProvider
+import VolatilityFunctions as vol
+import PricesFunctions as pr
+import BlackScholes as bs
+import PliqLoader
+import Graphs
+import QuantLib as ql
+import pandas as pd
+import numpy as np
+import contextlib
+import argparse
+import platform
+import tempfile
+import scipy
+import json
+import time
+import sys
+import io
+import os
+
+# Offline benchmarks for the pricing and calibration paths. Every run works on the bundled PLIQ file
+# and on synthetic chains priced with known Heston parameters, so two runs on the same machine only
+# differ by the library versions and the code under test.
+#
+#   python Benchmarks.py run --output benchmarks.json
+#   python Benchmarks.py compare baseline.json benchmarks.json --threshold 0.1
+
+SYNTHETIC_PARAMS = [0.04, 1.5, 0.04, 0.5, -0.6]
+
+def timings(function, repeat=3):
+    # Wall times of repeat calls; the last return value is kept for the benchmarks that need it
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        seconds.append(time.perf_counter() - start)
+    return {'median': float(np.median(seconds)), 'min': float(np.min(seconds)), 'mean': float(np.mean(seconds)),
+            'repeat': repeat}, result
+
+def synthetic_chain(call_or_put='Call', spot_price=100.0, strikes=np.linspace(80, 120, 9), ttms=(0.25, 0.5, 1.0),
+                    risk_free_rate=0.05, dividend_yield=0.01, params=SYNTHETIC_PARAMS, calculation_date='2023-09-12'):
+    # Chain in the layout HestonImpliedVolatility.opt_type builds, priced with known parameters
+    strike, ttm = [a.ravel() for a in np.meshgrid(np.asarray(strikes, dtype=float), np.asarray(ttms, dtype=float))]
+    days = np.rint(ttm * 365).astype(int)
+    ttm = days / 365.0
+    call_option = call_or_put == 'Call'
+    prices = pr.HestonNPVArray(*params, risk_free_rate, dividend_yield, ttm, spot_price, strike, call_option)
+    trade_date = pd.Timestamp(calculation_date)
+    return pd.DataFrame({
+        'strike': strike,
+        'lastPrice': prices,
+        'bid': prices * 0.99,
+        'ask': prices * 1.01,
+        'volume': np.full(len(strike), 100.0),
+        'impliedVolatility': bs.implied_volatility(prices, spot_price, strike, ttm, risk_free_rate, dividend_yield, call_option),
+        'Maturity': trade_date + pd.to_timedelta(days, unit='D'),
+        'lastTradeDate': trade_date,
+        'TTM': ttm,
+        'Price': np.full(len(strike), spot_price),
+        'Rate': np.full(len(strike), risk_free_rate)
+    })
+
+def pliq_chain(directory='Data', call_or_put='Call'):
+    return PliqLoader.pliq_option_frame(PliqLoader.load_pliq_directory(directory), call_or_put)
+
+def sample_quotes(option, quotes):
+    # Evenly spread subset, so every maturity of the chain stays represented
+    rows = np.unique(np.linspace(0, len(option) - 1, min(quotes, len(option))).astype(int))
+    return option.iloc[rows].reset_index(drop=True)
+
+def bench_heston_npv(repeat=3, quotes=200):
+    calculation_date, maturity_date = ql.Date(12, 9, 2023), ql.Date(12, 3, 2024)
+    strikes = np.linspace(80, 120, quotes)
+    ttm = ql.Actual365Fixed().yearFraction(calculation_date, maturity_date)
+    single, _ = timings(lambda: pr.HestonNPV(*SYNTHETIC_PARAMS, 0.05, 0.01, calculation_date, maturity_date, 100.0, 100.0), repeat * 10)
+    bulk, _ = timings(lambda: [pr.HestonNPV(*SYNTHETIC_PARAMS, 0.05, 0.01, calculation_date, maturity_date, 100.0, strike)
+                               for strike in strikes], repeat)
+    array, _ = timings(lambda: pr.HestonNPVArray(*SYNTHETIC_PARAMS, 0.05, 0.01, ttm, 100.0, strikes), repeat)
+    fft, _ = timings(lambda: pr.HestonNPVFFT(*SYNTHETIC_PARAMS, 0.05, 0.01, ttm, 100.0, strikes), repeat)
+    bulk['quotes'] = array['quotes'] = fft['quotes'] = quotes
+    return {'heston_npv_single': single, 'heston_npv_bulk': bulk, 'heston_npv_array': array, 'heston_npv_fft': fft}
+
+def bench_calibration(option, call_option, dividend_yield=0.0, label='synthetic'):
+    # One HestonParametersVolatility call per quote, with the same defaults get_results uses. Reports the
+    # wall time, objective evaluations and how many optimizers of the fallback chain were needed.
+    metrics = CalibrationMetrics()
+    for row in option.itertuples():
+        calculation_date, maturity_date = vol.to_ql_dates(row.lastTradeDate), vol.to_ql_dates(row.Maturity)
+        # The fallback chain reports every failed optimizer on stdout
+        with contextlib.redirect_stdout(io.StringIO()):
+            vol.HestonParametersVolatility(row.Price, row.strike, row.lastPrice, dividend_yield, [.1, .1, row.impliedVolatility, .1, .1],
+                                           calculation_date, maturity_date, row.TTM, risk_free_rate=row.Rate, call_option=call_option,
+                                           metrics=metrics)
+    quotes = metrics.to_frame()
+    return {f'calibration_quote_{label}': {'median': float(quotes['Seconds'].median()), 'min': float(quotes['Seconds'].min()),
+                                           'mean': float(quotes['Seconds'].mean()), 'repeat': len(quotes),
+                                           'evaluations_median': float(quotes['Evaluations'].median()),
+                                           'evaluations_max': int(quotes['Evaluations'].max()),
+                                           'fallback_depth_mean': float(quotes['Fallback_Depth'].mean()),
+                                           'fallback_depth_max': int(quotes['Fallback_Depth'].max())}}
+
+def bench_get_results(option, call_or_put, dividend_yield=0.0, label='synthetic', repeat=1):
+    # End to end get_results on a chain that already carries spot and rate, so no download is made
+    with tempfile.TemporaryDirectory() as cache_dir:
+        surface = HestonImpliedVolatility(label, provider=MarketDataProvider(cache_dir=cache_dir, offline=True))
+        surface.option = option
+        surface.call_option = call_or_put == 'Call'
+        surface.dividend = dividend_yield
+        surface.rf = option['Rate'].mean()
+        with contextlib.redirect_stdout(io.StringIO()):
+            result, table = timings(lambda: surface.get_results(), repeat)
+    result['quotes'] = len(option)
+    results = surface.results
+    expected, _ = timings(lambda: vol.calculate_expected_variance_over_strikes(results.copy()), 10)
+    surface_figure, _ = timings(lambda: Graphs.vol_surface(table), 10)
+    return {f'get_results_{label}': result, f'expected_variance_{label}': expected, f'vol_surface_{label}': surface_figure}
+
+def environment():
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'numpy': np.__version__,
+            'scipy': scipy.__version__, 'pandas': pd.__version__, 'quantlib': ql.__version__,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+def run_benchmarks(repeat=3, quotes=12, directory='Data'):
+    benchmarks = {}
+    benchmarks.update(bench_heston_npv(repeat))
+    synthetic = sample_quotes(synthetic_chain(), quotes)
+    benchmarks.update(bench_calibration(synthetic, True, 0.01, 'synthetic'))
+    benchmarks.update(bench_get_results(synthetic, 'Call', 0.01, 'synthetic'))
+    pliq = sample_quotes(pliq_chain(directory), quotes)
+    benchmarks.update(bench_calibration(pliq, True, 0.0, 'pliq'))
+    benchmarks.update(bench_get_results(pliq, 'Call', 0.0, 'pliq'))
+    return {'environment': environment(), 'benchmarks': benchmarks}
+
+def compare(baseline, current, threshold=0.1, statistic='median'):
+    # One row per benchmark present in both runs; a time more than threshold (relative) above the
+    # baseline is a regression
+    rows = []
+    for name, old in baseline['benchmarks'].items():
+        new = current['benchmarks'].get(name)
+        if new is None:
+            continue
+        ratio = new[statistic] / old[statistic] if old[statistic] > 0 else np.inf
+        status = 'REGRESSION' if ratio > 1 + threshold else 'IMPROVEMENT' if ratio < 1 - threshold else 'OK'
+        rows.append({'Benchmark': name, 'Baseline': old[statistic], 'Current': new[statistic], 'Ratio': ratio, 'Status': status})
+    return pd.DataFrame(rows, columns=['Benchmark', 'Baseline', 'Current', 'Ratio', 'Status'])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks de valuación y calibración Heston')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser('run')
+    run.add_argument('--output', default='benchmarks.json')
+    run.add_argument('--repeat', type=int, default=3)
+    run.add_argument('--quotes', type=int, default=12)
+    run.add_argument('--data', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Data'))
+    comparison = commands.add_parser('compare')
+    comparison.add_argument('baseline')
+    comparison.add_argument('current')
+    comparison.add_argument('--threshold', type=float, default=0.1)
+    comparison.add_argument('--statistic', default='median', choices=['median', 'min', 'mean'])
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        results = run_benchmarks(args.repeat, args.quotes, args.data)
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+        for name, result in results['benchmarks'].items():
+            print(f'{name:35s} {result["median"] * 1000:12.3f} ms')
+        return 0
+
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    with open(args.current) as file:
+        current = json.load(file)
+    table = compare(baseline, current, args.threshold, args.statistic)
+    print(table.to_string(index=False))
+    # Non-zero exit code on regressions, so the comparison can gate a CI job
+    return 1 if (table['Status'] == 'REGRESSION').any() else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,91 @@
+from scipy.stats import norm
+import numpy as np
+
+# Array Black-Scholes with an explicit spot and time to maturity: every argument broadcasts, so a whole
+# chain is priced, differentiated or inverted in one vectorized pass
+
+def black_scholes_price(spot_price, strike_price, ttm, risk_free_rate, dividend_yield, volatility, call_option=True):
+    S, K, T, r, q, sigma, call = np.broadcast_arrays(*[np.asarray(a, dtype=float) for a in
+                                                       (spot_price, strike_price, ttm, risk_free_rate, dividend_yield, volatility, call_option)])
+    call = call.astype(bool)
+    T = np.maximum(T, 1e-12)
+    sqrt_t = np.sqrt(T)
+    d1 = (np.log(S / K) + (r - q + 0.5 * sigma ** 2) * T) / (sigma * sqrt_t)
+    d2 = d1 - sigma * sqrt_t
+    call_price = S * np.exp(-q * T) * norm.cdf(d1) - K * np.exp(-r * T) * norm.cdf(d2)
+    put_price = K * np.exp(-r * T) * norm.cdf(-d2) - S * np.exp(-q * T) * norm.cdf(-d1)
+    return np.where(call, call_price, put_price)
+
+def black_scholes_greeks(spot_price, strike_price, ttm, risk_free_rate, dividend_yield, volatility, call_option=True):
+    # Delta, gamma, vega (per unit of volatility), theta (per year) and rho (per unit of rate)
+    S, K, T, r, q, sigma, call = np.broadcast_arrays(*[np.asarray(a, dtype=float) for a in
+                                                       (spot_price, strike_price, ttm, risk_free_rate, dividend_yield, volatility, call_option)])
+    call = call.astype(bool)
+    T = np.maximum(T, 1e-12)
+    sqrt_t = np.sqrt(T)
+    d1 = (np.log(S / K) + (r - q + 0.5 * sigma ** 2) * T) / (sigma * sqrt_t)
+    d2 = d1 - sigma * sqrt_t
+    dividend_discount, discount = np.exp(-q * T), np.exp(-r * T)
+    pdf_d1 = norm.pdf(d1)
+    sign = np.where(call, 1.0, -1.0)
+    delta = sign * dividend_discount * norm.cdf(sign * d1)
+    gamma = dividend_discount * pdf_d1 / (S * sigma * sqrt_t)
+    vega = S * dividend_discount * pdf_d1 * sqrt_t
+    theta = (-S * dividend_discount * pdf_d1 * sigma / (2 * sqrt_t)
+             - sign * r * K * discount * norm.cdf(sign * d2) + sign * q * S * dividend_discount * norm.cdf(sign * d1))
+    rho = sign * K * T * discount * norm.cdf(sign * d2)
+    return {'delta': delta, 'gamma': gamma, 'vega': vega, 'theta': theta, 'rho': rho}
+
+def normalized_call(x, s):
+    # Undiscounted call over sqrt(F K) as a function of log-moneyness x = log(F / K) and total volatility s
+    return np.exp(0.5 * x) * norm.cdf(x / s + 0.5 * s) - np.exp(-0.5 * x) * norm.cdf(x / s - 0.5 * s)
+
+def implied_volatility(option_price, spot_price, strike_price, ttm, risk_free_rate, dividend_yield, call_option=True,
+                       tolerance=1e-10, max_iterations=30):
+    # Vectorized implied volatility. The price is mapped to a normalized out-of-the-money call, the
+    # Corrado-Miller closed form (or the inflection point of the price curve where it breaks down) gives
+    # the initial total volatility, and bracketed Halley steps refine every contract at once. Prices
+    # outside the no-arbitrage bounds return NaN.
+    price, S, K, T, r, q, call = np.broadcast_arrays(*[np.asarray(a, dtype=float) for a in
+                                                       (option_price, spot_price, strike_price, ttm, risk_free_rate, dividend_yield, call_option)])
+    call = call.astype(bool)
+    T = np.maximum(T, 1e-12)
+    discount = np.exp(-r * T)
+    forward = S * np.exp((r - q) * T)
+    x = np.log(forward / K)
+    # Put-call parity to a call, then the in-the-money calls to out-of-the-money ones (x -> -x)
+    call_price = np.where(call, price, price + discount * (forward - K))
+    target = call_price / (discount * np.sqrt(forward * K))
+    intrinsic = np.maximum(np.exp(0.5 * x) - np.exp(-0.5 * x), 0.0)
+    valid = (target > intrinsic) & (target < np.exp(0.5 * x))
+    target = np.where(x > 0, target - (np.exp(0.5 * x) - np.exp(-0.5 * x)), target)
+    x = -np.abs(x)
+    target = np.where(valid, target, 0.5 * np.exp(0.5 * x))
+
+    # Corrado-Miller in normalized units
+    half_gap = 0.5 * (np.exp(0.5 * x) - np.exp(-0.5 * x))
+    discriminant = (target - half_gap) ** 2 - 4 * half_gap ** 2 / np.pi
+    s = np.sqrt(2 * np.pi) / (np.exp(0.5 * x) + np.exp(-0.5 * x)) * (target - half_gap + np.sqrt(np.maximum(discriminant, 0.0)))
+    inflection = np.sqrt(2 * np.abs(x))
+    s = np.where((discriminant > 0) & (s > 0), s, np.maximum(inflection, 1e-2))
+
+    lower, upper = np.zeros_like(s), np.full_like(s, 20.0)
+    active = np.ones(s.shape, dtype=bool)
+    for _ in range(max_iterations):
+        s = np.clip(s, 1e-8, upper)
+        f = normalized_call(x, s) - target
+        lower = np.where(f < 0, np.maximum(lower, s), lower)
+        upper = np.where(f > 0, np.minimum(upper, s), upper)
+        active = np.abs(f) > tolerance * np.maximum(target, 1e-300)
+        if not active.any():
+            break
+        vega = np.exp(0.5 * x) * norm.pdf(x / s + 0.5 * s)
+        volga = vega * (x ** 2 / s ** 3 - s / 4)
+        newton = f / np.maximum(vega, 1e-300)
+        step = newton / np.maximum(1.0 - 0.5 * newton * volga / np.maximum(vega, 1e-300), 0.5)
+        candidate = s - step
+        # Fall back to bisection whenever the step leaves the bracket
+        candidate = np.where((candidate > lower) & (candidate < upper), candidate, 0.5 * (lower + upper))
+        s = np.where(active, candidate, s)
+
+    return np.where(valid, s / np.sqrt(T), np.nan)
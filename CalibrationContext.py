@@ -0,0 +1,74 @@
+from ValuationContext import evaluation_date
+import MarketEnvironment
+import QuantLib as ql
+import numpy as np
+
+def valid_heston_params(params):
+    # The domain the QuantLib Heston model accepts: positive v0, kappa, theta and sigma and |rho| < 1.
+    # setParams does not check it, so it is checked here.
+    v0, kappa, theta, sigma, rho = params
+    return v0 > 0 and kappa > 0 and theta > 0 and sigma > 0 and abs(rho) < 1
+
+class HestonCalibrationContext():
+    # Builds the term structures, spot quote, Heston process, model and engine once per
+    # (calculation date, maturity, spot) group. Every optimizer evaluation only pushes new parameters
+    # into the model, which notifies the engine and reprices the attached options. Prices are computed at
+    # calculation_date whatever the global QuantLib evaluation date is (see ValuationContext); one context
+    # must not be used by two threads at once, but any number of contexts can.
+    def __init__(self, calculation_date, maturity_date, spot_price, dividend_yield, risk_free_rate=0.00525, call_option=True,
+                 strikes=(), initial_params=(.1, .1, .1, .1, .1), environment=None):
+        # Flat curves come from the shared MarketEnvironment
+        self.day_count = ql.Actual365Fixed()
+        self.calculation_date = calculation_date
+        self.maturity_date = maturity_date
+        self.option_type = ql.Option.Call if call_option else ql.Option.Put
+
+        environment = MarketEnvironment.default_environment if environment is None else environment
+        self.risk_free_ts = environment.flat_curve(calculation_date, risk_free_rate)
+        self.dividend_yield_ts = environment.flat_curve(calculation_date, dividend_yield)
+        self.spot_quote = ql.SimpleQuote(spot_price)
+        v0, kappa, theta, sigma, rho = initial_params
+        self.process = ql.HestonProcess(self.risk_free_ts, self.dividend_yield_ts, ql.QuoteHandle(self.spot_quote),
+                                        v0, kappa, theta, sigma, rho)
+        self.model = ql.HestonModel(self.process)
+        self.engine = ql.AnalyticHestonEngine(self.model)
+        self.exercise = ql.EuropeanExercise(maturity_date)
+        self.options = {}
+        self.params = None
+        for strike_price in strikes:
+            self.option(strike_price)
+
+    def option(self, strike_price):
+        # Options are created once per strike and share the engine
+        if strike_price not in self.options:
+            option = ql.VanillaOption(ql.PlainVanillaPayoff(self.option_type, strike_price), self.exercise)
+            option.setPricingEngine(self.engine)
+            self.options[strike_price] = option
+        return self.options[strike_price]
+
+    def set_params(self, params):
+        params = tuple(float(p) for p in params)
+        if params != self.params:
+            if not valid_heston_params(params):
+                raise ValueError(f'Parámetros de Heston fuera del dominio: {params}')
+            v0, kappa, theta, sigma, rho = params
+            # HestonModel stores its parameters as (theta, kappa, sigma, rho, v0)
+            self.model.setParams(ql.Array([theta, kappa, sigma, rho, v0]))
+            self.params = params
+
+    def set_spot(self, spot_price):
+        self.spot_quote.setValue(spot_price)
+
+    def npv(self, params, strike_price):
+        # The model (and its observers) only change under the lock, like every other QuantLib call
+        option = self.option(strike_price)
+        with evaluation_date(self.calculation_date):
+            self.set_params(params)
+            return option.NPV()
+
+    def npvs(self, params, strikes=None):
+        strikes = list(self.options.keys()) if strikes is None else strikes
+        options = [self.option(strike_price) for strike_price in strikes]
+        with evaluation_date(self.calculation_date):
+            self.set_params(params)
+            return np.array([option.NPV() for option in options])
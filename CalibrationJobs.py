@@ -0,0 +1,175 @@
+from concurrent.futures import ThreadPoolExecutor
+from HestonVolatilities import HestonImpliedVolatility
+from VolatilitySurface import VolatilitySurface
+from collections import OrderedDict
+import pandas as pd
+import traceback
+import threading
+import hashlib
+import shutil
+import time
+import os
+
+# Background calibrations for the Streamlit app. One JobManager per process runs the jobs in a small
+# thread pool and keys them by (ticker, option type, calibration mode, data snapshot), the snapshot
+# being MarketDataProvider.snapshot of the cached market data: a request for a key that is already
+# running or finished gets that job instead of a new one, so concurrent sessions share one calibration
+# and reruns find the finished tables and surfaces. A job that downloads new data is also filed under
+# the snapshot of the data it used, and the latest job of every (ticker, option type, mode) can be
+# looked up while the data it is downloading changes the snapshot. With a cache_dir finished results
+# are also written to disk, at most max_cached of them, and survive a restart of the app.
+
+def job_key(ticker, call_or_put, calibration, snapshot):
+    return (str(ticker).upper(), call_or_put, calibration, str(snapshot))
+
+class CalibrationJob():
+    def __init__(self, key):
+        self.key = key
+        self.status = 'pending'
+        self.stage = 'En espera'
+        self.done = 0
+        self.total = 0
+        self.result = None
+        self.snapshot = None
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished_at = None
+
+    def progress(self, done, total):
+        # Called by the calibration after every quote (or maturity slice)
+        self.done, self.total = done, total
+
+    def fraction(self):
+        if self.status == 'done':
+            return 1.0
+        return self.done / self.total if self.total else 0.0
+
+    def finished(self):
+        return self.status in ('done', 'failed')
+
+class JobManager():
+    def __init__(self, max_workers: int = 2, max_jobs: int = 32, cache_dir=None, max_cached: int = 64):
+        # At most max_jobs finished jobs are kept in memory, least recently requested first out; running
+        # jobs are never dropped. On disk the least recently used results beyond max_cached are deleted.
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='calibration')
+        self.max_jobs = max_jobs
+        self.cache_dir = cache_dir
+        self.max_cached = max_cached
+        self.jobs = OrderedDict()
+        self.latest_jobs = {}
+        self.lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def result_dir(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha1('|'.join(key).encode()).hexdigest())
+
+    def save_result(self, key, result):
+        directory = self.result_dir(key)
+        os.makedirs(directory, exist_ok=True)
+        if result['surface'] is not None:
+            result['surface'].save(os.path.join(directory, 'surface.npz'))
+        # The table is written last: its presence marks a complete entry
+        result['table'].to_parquet(os.path.join(directory, 'table.tmp.parquet'))
+        os.replace(os.path.join(directory, 'table.tmp.parquet'), os.path.join(directory, 'table.parquet'))
+        self.prune_cache()
+
+    def prune_cache(self):
+        # Entries are ordered by the modification time of their table, refreshed on every load
+        entries = [entry.path for entry in os.scandir(self.cache_dir) if entry.is_dir()]
+        used = {path: os.path.getmtime(os.path.join(path, 'table.parquet')) if os.path.exists(os.path.join(path, 'table.parquet')) else 0.0
+                for path in entries}
+        for path in sorted(entries, key=used.get)[:max(len(entries) - self.max_cached, 0)]:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def load_result(self, key):
+        directory = self.result_dir(key)
+        if not os.path.exists(os.path.join(directory, 'table.parquet')):
+            return None
+        os.utime(os.path.join(directory, 'table.parquet'))
+        surface_path = os.path.join(directory, 'surface.npz')
+        return {'table': pd.read_parquet(os.path.join(directory, 'table.parquet')),
+                'surface': VolatilitySurface.load(surface_path) if os.path.exists(surface_path) else None}
+
+    def lookup(self, key):
+        # Caller holds the lock
+        if key in self.jobs:
+            self.jobs.move_to_end(key)
+            return self.jobs[key]
+        result = None if self.cache_dir is None else self.load_result(key)
+        if result is None:
+            return None
+        job = CalibrationJob(key)
+        job.status, job.stage, job.result = 'done', 'Listo', result
+        self.add(job)
+        return job
+
+    def add(self, job):
+        self.jobs[job.key] = job
+        finished = [key for key, other in self.jobs.items() if other.finished()]
+        for key in finished[:max(len(self.jobs) - self.max_jobs, 0)]:
+            del self.jobs[key]
+
+    def get(self, key):
+        with self.lock:
+            return self.lookup(key)
+
+    def latest(self, ticker, call_or_put, calibration):
+        # The last job submitted for these options, whatever its snapshot
+        with self.lock:
+            return self.latest_jobs.get(job_key(ticker, call_or_put, calibration, None)[:3])
+
+    def submit(self, key, function, refresh=False):
+        # function(job) runs in the pool and returns {'table': ..., 'surface': ...}, setting job.snapshot
+        # once it knows the data it works on. A failed job is replaced by a new one, and so is a finished
+        # one with refresh (its data is stale and will be downloaded again); any other job of the same key,
+        # or any running job of the same options, is returned as is.
+        with self.lock:
+            job = self.lookup(key)
+            if job is not None and job.status != 'failed' and not (refresh and job.finished()):
+                return job
+            # A job of the same options still running (its downloads may have changed the snapshot)
+            latest = self.latest_jobs.get(key[:3])
+            if latest is not None and not latest.finished():
+                return latest
+            job = CalibrationJob(key)
+            self.add(job)
+            self.latest_jobs[key[:3]] = job
+        self.executor.submit(self.run, job, function)
+        return job
+
+    def run(self, job, function):
+        job.status, job.started = 'running', time.time()
+        try:
+            job.result = function(job)
+            # Results are filed under the snapshot of the data the job actually used
+            key = job.key if job.snapshot is None else job.key[:3] + (str(job.snapshot),)
+            if key != job.key:
+                with self.lock:
+                    self.jobs[key] = job
+            if self.cache_dir is not None:
+                self.save_result(key, job.result)
+            job.stage, job.status = 'Listo', 'done'
+        except Exception as e:
+            traceback.print_exc()
+            job.error = str(e)
+            job.stage, job.status = 'Error', 'failed'
+        job.finished_at = time.time()
+
+def volatility_job(provider, ticker, call_or_put, calibration):
+    # The body of the "Encontrar volatilidad suavizada" job: market data, then one progress step per quote
+    def run(job):
+        job.stage = 'Descargando datos de mercado'
+        volatility = HestonImpliedVolatility(ticker, provider=provider)
+        volatility.get_dividend_yield()
+        volatility.get_risk_free()
+        volatility.opt_type(call_or_put)
+        job.stage = 'Calibrando'
+        job.progress(0, len(volatility.option))
+        table = volatility.get_results(calibration=calibration, weighting=None if calibration == 'quote' else 'vega', chunk_size=1,
+                                       progress=job.progress)
+        # Every download of the job is done by now
+        job.snapshot = provider.snapshot(ticker)
+        return {'table': table, 'surface': getattr(volatility, 'surface', None)}
+    return run
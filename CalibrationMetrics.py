@@ -0,0 +1,78 @@
+import pandas as pd
+import json
+import time
+
+class CalibrationMetrics():
+    # Collector passed to HestonParametersVolatility (or get_results) to record what each calibration
+    # cost: one record per quote with the time, objective evaluations and outcome of every optimizer
+    # stage that ran. Records are plain dicts, so worker processes can fill their own collector and the
+    # parent merges them with extend. Without a collector nothing is recorded.
+    def __init__(self):
+        self.records = []
+
+    def record(self, strike_price, ttm, maturity_date, market_price, optimizer, success, residual, stages, seconds):
+        self.records.append({'Strike': float(strike_price), 'TTM': float(ttm),
+                             'Maturity': maturity_date.ISO() if hasattr(maturity_date, 'ISO') else str(maturity_date),
+                             'Market_Price': None if market_price is None else float(market_price),
+                             'Optimizer': optimizer, 'Success': bool(success),
+                             'Residual': None if residual is None else float(residual),
+                             'Stages': stages, 'Seconds': float(seconds),
+                             'Evaluations': int(sum(stage['Evaluations'] for stage in stages)),
+                             'Fallback_Depth': len(stages)})
+
+    def extend(self, records):
+        self.records.extend(records)
+
+    def clear(self):
+        self.records = []
+
+    def to_frame(self):
+        # One row per quote
+        columns = ['Strike', 'TTM', 'Maturity', 'Market_Price', 'Optimizer', 'Success', 'Residual', 'Seconds', 'Evaluations', 'Fallback_Depth']
+        return pd.DataFrame([{column: record[column] for column in columns} for record in self.records], columns=columns)
+
+    def stages(self):
+        # One row per optimizer stage of every quote
+        columns = ['Strike', 'TTM', 'Maturity', 'Stage', 'Seconds', 'Evaluations', 'Success', 'Objective_Value', 'Message']
+        rows = [{'Strike': record['Strike'], 'TTM': record['TTM'], 'Maturity': record['Maturity'], **stage}
+                for record in self.records for stage in record['Stages']]
+        return pd.DataFrame(rows, columns=columns)
+
+    def summary(self):
+        # Totals per optimizer stage: how often it ran, failed, and how much time and evaluations it took
+        stages = self.stages()
+        if not len(stages):
+            return pd.DataFrame(columns=['Stage', 'Runs', 'Failures', 'Seconds', 'Evaluations'])
+        grouped = stages.groupby('Stage', sort=False)
+        return pd.DataFrame({'Runs': grouped.size(), 'Failures': grouped['Success'].apply(lambda s: int((~s.astype(bool)).sum())),
+                             'Seconds': grouped['Seconds'].sum(), 'Evaluations': grouped['Evaluations'].sum()}).reset_index()
+
+    def expensive(self, n=10):
+        # The quotes that took the most time, with how deep they went into the fallback chain
+        return self.to_frame().sort_values('Seconds', ascending=False).head(n)
+
+    def to_json(self, path=None):
+        text = json.dumps({'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'records': self.records}, indent=2)
+        if path is not None:
+            with open(path, 'w') as file:
+                file.write(text)
+        return text
+
+    def to_prometheus(self, prefix='heston_calibration'):
+        # Prometheus text exposition format
+        quotes = self.to_frame()
+        summary = self.summary()
+        lines = [f'# TYPE {prefix}_quotes_total counter']
+        for optimizer, count in quotes.groupby('Optimizer').size().items():
+            lines.append(f'{prefix}_quotes_total{{optimizer="{optimizer}"}} {count}')
+        lines.append(f'# TYPE {prefix}_seconds_total counter')
+        lines.append(f'{prefix}_seconds_total {quotes["Seconds"].sum():.6f}')
+        lines.append(f'# TYPE {prefix}_evaluations_total counter')
+        lines.append(f'{prefix}_evaluations_total {int(quotes["Evaluations"].sum())}')
+        for name, column in (('stage_runs_total', 'Runs'), ('stage_failures_total', 'Failures'),
+                             ('stage_seconds_total', 'Seconds'), ('stage_evaluations_total', 'Evaluations')):
+            lines.append(f'# TYPE {prefix}_{name} counter')
+            for row in summary.itertuples():
+                value = getattr(row, column)
+                lines.append(f'{prefix}_{name}{{stage="{row.Stage}"}} ' + (f'{value:.6f}' if column == 'Seconds' else f'{int(value)}'))
+        return '\n'.join(lines) + '\n'
@@ -1,7 +1,8 @@
 from plotly.subplots import make_subplots
 import plotly.graph_objects as go
 import matplotlib.pyplot as plt
-import PricesFunctions
+import Sensitivity
+import QuantLib as ql
 import numpy as np
 
 def vol_surface(results):
@@ -28,9 +29,46 @@ def vol_surface(results):
     )
     return fig
 
-def sensibility(risk_free_rate, dividend_yield, calculation_date, maturity_date, spot_price, strike_price, call_or_put):
+def vol_surface_grid(strikes, ttms, vols):
+    # Same view as vol_surface, drawn from a regular grid (vols has one row per TTM)
+    fig = go.Figure(data=[go.Surface(
+        x=strikes,
+        y=ttms,
+        z=vols,
+        opacity=0.9,
+        colorscale='Viridis'
+    )])
+
+    fig.update_layout(
+        scene=dict(
+            xaxis_title='Strike Price',
+            yaxis_title='Time to Maturity (TTM)',
+            zaxis_title='Implied Volatility'
+        ),
+        autosize=True,
+        margin=dict(l=0, r=0, b=0, t=0)
+    )
+    return fig
+
+# Base values for parameters shared by the sensitivity plots
+SENSIBILITY_BASE = {
+    'v0': 0.02,
+    'kappa': 2,
+    'theta': 0.02,
+    'sigma': 0.2,
+    'rho': 0
+}
+
+def sensibility_base(calculation_date, maturity_date, spot_price, strike_price, params=None):
+    base = dict(SENSIBILITY_BASE if params is None else params)
+    base.update(spot_price=spot_price, strike_price=strike_price, ttm=ql.Actual365Fixed().yearFraction(calculation_date, maturity_date))
+    return base
+
+def sensibility(risk_free_rate, dividend_yield, calculation_date, maturity_date, spot_price, strike_price, call_or_put, engine=None, params=None):
+    # params ({'v0': ..., 'rho': ...}) are the Heston parameters the sweeps start from, SENSIBILITY_BASE by default
     # Define the constant parameters for the option
     call_option = True if call_or_put == 'Call' else False
+    engine = Sensitivity.SensitivityEngine(risk_free_rate, dividend_yield, call_option) if engine is None else engine
 
     # Define the ranges for the parameters you want to vary
     param_ranges = {
@@ -52,22 +90,11 @@ def sensibility(risk_free_rate, dividend_yield, calculation_date, maturity_date,
         template="plotly_white"
     )
 
+    base = sensibility_base(calculation_date, maturity_date, spot_price, strike_price, params)
+
     for i, (param, values) in enumerate(param_ranges.items(), start=1):
-        prices = []
-        for value in values:
-            # Set base values for parameters
-            args = {
-                'v0': 0.02,
-                'kappa': 2,
-                'theta': 0.02,
-                'sigma': 0.2,
-                'rho': 0
-            }
-            args[param] = value  # Vary the parameter
-            price = PricesFunctions.HestonNPV(**args, risk_free_rate=risk_free_rate, dividend_yield=dividend_yield,
-                              calculation_date=calculation_date, maturity_date=maturity_date,
-                              spot_price=spot_price, strike_price=strike_price, call_option=call_option)
-            prices.append(price)
+        # Price the whole sweep in one vectorized call
+        prices = engine.grid(base, {param: values})
         sensitivity_results[param] = prices
 
         # Add trace to the respective subplot
@@ -79,4 +106,25 @@ def sensibility(risk_free_rate, dividend_yield, calculation_date, maturity_date,
         # Update xaxis and yaxis properties if necessary
         fig.update_xaxes(title_text=param, row=1, col=i)
         fig.update_yaxes(title_text='Option Price', row=1, col=i)
-    return fig
\ No newline at end of file
+    return fig
+
+def sensibility_range(param, base, points=60):
+    # Default axis for a heatmap around the base contract
+    if param in ('spot_price', 'strike_price'):
+        return np.linspace(0.7 * base[param], 1.3 * base[param], points)
+    if param == 'ttm':
+        return np.linspace(1 / 365, 2 * base['ttm'], points)
+    ranges = {'v0': (0.005, 0.1), 'kappa': (0.1, 5), 'theta': (0.005, 0.1), 'sigma': (0.05, 1), 'rho': (-0.9, 0.9)}
+    return np.linspace(*ranges[param], points)
+
+def sensibility_heatmap(engine, base, x_param, x_values, y_param, y_values):
+    # 2-D price map over any two of Sensitivity.GRID_NAMES, priced in one batched call
+    prices = engine.grid(base, {y_param: y_values, x_param: x_values})
+    fig = go.Figure(data=[go.Heatmap(x=x_values, y=y_values, z=prices, colorscale='Viridis', colorbar=dict(title='Option Price'))])
+    fig.update_layout(
+        xaxis_title=x_param,
+        yaxis_title=y_param,
+        template="plotly_white",
+        margin=dict(l=0, r=0, b=0, t=30)
+    )
+    return fig
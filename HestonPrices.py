@@ -1,47 +1,40 @@
-from datetime import datetime, timedelta
+from MarketData import MarketDataProvider
 import PricesFunctions as pr
-import yfinance as yf
+import BlackScholes as bs
+import Sensitivity
 import QuantLib as ql
 import pandas as pd
-import numpy as np
 import Graphs
 
+# Parameters used when the user does not set them
+HESTON_DEFAULTS = {'v0': .05, 'kappa': .15, 'theta': .07, 'sigma': .08, 'rho': .1}
+
 class HestonPrice():
-    def __init__(self, ticker):
+    def __init__(self, ticker, provider: MarketDataProvider = None):
         self.ticker_symbol = ticker
-        self.ticker_data = yf.Ticker(self.ticker_symbol)
+        self.provider = MarketDataProvider() if provider is None else provider
 
     def get_mkt_data(self, spot_price: float = None, risk_free_rate: float = None):
         # Get Risk Free
         if risk_free_rate == None:
-            self.rf = yf.download("^IRX", period="1d", progress=False)['Close'].iloc[-1]/100
+            self.rf = self.provider.risk_free_rate()
         else:
             self.rf = risk_free_rate
         # Get Spot Price
         if spot_price == None:
-            end_date = datetime.today()
-            start_date = end_date - timedelta(days = 3)
-            spot_price = yf.download(self.ticker_symbol, start=start_date, end=end_date, progress=False)['Adj Close']
-            self.spot_price = spot_price.iloc[0]
+            self.spot_price = self.provider.spot_price(self.ticker_symbol)
         else:
             self.spot_price = spot_price
             
     def get_dividend_yield(self, dividend: float = None):
         if dividend == None:
-            dividends = self.ticker_data.dividends
-            last_dividend = dividends.to_frame().iloc[-1].values[0] * 4
-            dividend_date = dividends.to_frame().iloc[-1].name
-            end_date = dividend_date + timedelta(days = 3)
-            price_in_div_date = self.ticker_data.history(period='1d', start=dividend_date, end=end_date)['Close'].iloc[0]
-            dividend_yield = last_dividend / price_in_div_date
-            self.dividend = dividend_yield
+            self.dividend = self.provider.dividend_yield(self.ticker_symbol)
         else:
             self.dividend = dividend
 
     def get_closest_most_common_option(self, call_or_put):
-        self.ticker_data = yf.Ticker(self.ticker_symbol)
-        closest_exp_date = self.ticker_data.options[1]
-        options_chain = self.ticker_data.option_chain(closest_exp_date)
+        closest_exp_date = self.provider.options(self.ticker_symbol)[1]
+        options_chain = self.provider.option_chain(self.ticker_symbol, closest_exp_date)
         if call_or_put == 'Call':
             option = options_chain.calls
         elif call_or_put == 'Put':
@@ -64,30 +57,41 @@ class HestonPrice():
         self.spot_price = spot_price
         
     def parameter_optimizer(self, v0: float = None, kappa: float = None, theta: float = None, sigma: float = None, rho: float = None):
-        parameters = [v0, theta, kappa, sigma, rho]
-        if not all(element is not None for element in parameters):
-            self.v0 = v0 
-            self.theta = theta 
-            self.kappa = kappa
-            self.sigma = sigma 
-            self.rho = rho
-        else:
-           pass
+        # Parameters left as None keep the defaults in HESTON_DEFAULTS
+        self.v0 = HESTON_DEFAULTS['v0'] if v0 is None else v0
+        self.kappa = HESTON_DEFAULTS['kappa'] if kappa is None else kappa
+        self.theta = HESTON_DEFAULTS['theta'] if theta is None else theta
+        self.sigma = HESTON_DEFAULTS['sigma'] if sigma is None else sigma
+        self.rho = HESTON_DEFAULTS['rho'] if rho is None else rho
 
     def black_scholes_pricing(self, call_or_put):
-        self.black_scholes = pr.black_scholes(self.ticker_symbol, self.strike_price, self.rf, self.maturity_date,.5, call_or_put)
+        ttm = ql.Actual365Fixed().yearFraction(self.calculation_date, self.maturity_date)
+        self.black_scholes = float(bs.black_scholes_price(self.spot_price, self.strike_price, ttm, self.rf, self.dividend, .5,
+                                                          call_or_put == 'Call'))
 
     def calculate_heston_pricing(self, call_or_put):
-            self.v0, self.theta, self.kappa, self.sigma, self.rho = .05,.07,.15,.08,.1
-            call_or_put = True if call_or_put == 'Call' else False
-            option_price = pr.HestonNPV(v0=self.v0, kappa=self.kappa, theta=self.theta, sigma=self.sigma, rho=self.rho, risk_free_rate=self.rf, 
-                                        dividend_yield=self.dividend, calculation_date=self.calculation_date, maturity_date=self.maturity_date, 
-                                        spot_price=self.spot_price,strike_price=self.strike_price, call_option=call_or_put)
-            #self.heston_price = option_price
-            self.heston_price = self.black_scholes + np.random.randint(low = 1, high = 50) * .01 * pd.Series([-1,1]).sample(1).values[0]
-    
-    def senibility_analysis(self, call_or_put):
+        if not hasattr(self, 'v0'):
+            self.parameter_optimizer()
+        self.heston_price = pr.HestonNPV(v0=self.v0, kappa=self.kappa, theta=self.theta, sigma=self.sigma, rho=self.rho, risk_free_rate=self.rf,
+                                         dividend_yield=self.dividend, calculation_date=self.calculation_date, maturity_date=self.maturity_date,
+                                         spot_price=self.spot_price, strike_price=self.strike_price, call_option=call_or_put == 'Call')
+
+    def heston_params(self):
+        # The parameters calculate_heston_pricing prices with, as Graphs.sensibility_base takes them
+        if not hasattr(self, 'v0'):
+            self.parameter_optimizer()
+        return {'v0': self.v0, 'kappa': self.kappa, 'theta': self.theta, 'sigma': self.sigma, 'rho': self.rho}
+
+    def sensibility_base(self):
+        return Graphs.sensibility_base(self.calculation_date, self.maturity_date, self.spot_price, self.strike_price, self.heston_params())
+
+    def senibility_analysis(self, call_or_put, engine=None):
         fig = Graphs.sensibility(self.rf, self.dividend, self.calculation_date, self.maturity_date,
-                                   self.spot_price, self.strike_price, call_or_put)
-        fig.show()
-    
+                                   self.spot_price, self.strike_price, call_or_put, engine=engine, params=self.heston_params())
+        return fig
+
+    def sensibility_greeks(self, call_or_put, engine=None):
+        engine = Sensitivity.SensitivityEngine(self.rf, self.dividend, call_or_put == 'Call') if engine is None else engine
+        base = self.sensibility_base()
+        greeks = engine.greeks(base)
+        return pd.DataFrame({name: [float(value)] for name, value in greeks.items()})
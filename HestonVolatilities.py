@@ -1,39 +1,48 @@
 import VolatilityFunctions as vol
+import ParallelCalibration
+import ParameterCache
+import PliqLoader
+import MarketEnvironment
+import BlackScholes as bs
 import plotly.graph_objects as go
 from datetime import timedelta
-import yfinance as yf
+from MarketData import MarketDataProvider
+from VolatilitySurface import VolatilitySurface
+from ResultStore import CalibrationResults
 import pandas as pd
+import numpy as np
 import Graphs
 import warnings
 
 class HestonImpliedVolatility():
-    def __init__(self, ticker):
+    def __init__(self, ticker, provider: MarketDataProvider = None):
         self.ticker_symbol = ticker
-        self.ticker_data = yf.Ticker(self.ticker_symbol)
-        self.expiration_date = self.ticker_data.options
+        self.provider = MarketDataProvider() if provider is None else provider
 
     def get_dividend_yield(self, dividend: float = None):
         if dividend == None:
-            dividends = self.ticker_data.dividends
-            last_dividend = dividends.to_frame().iloc[-1].values[0] * 4
-            dividend_date = dividends.to_frame().iloc[-1].name
-            end_date = dividend_date + timedelta(days = 3)
-            price_in_div_date = self.ticker_data.history(period='1d', start=dividend_date, end=end_date)['Close'].iloc[0]
-            dividend_yield = last_dividend / price_in_div_date
-            self.dividend = dividend_yield
+            self.dividend = self.provider.dividend_yield(self.ticker_symbol)
         else:
             self.dividend = dividend
 
     def get_risk_free(self, risk_free_rate: float = None):
         if risk_free_rate == None:
-            self.rf = yf.download("^IRX", period="1d", progress=False)['Close'].iloc[-1]/100
+            self.rf = self.provider.risk_free_rate()
         else:
             self.rf = risk_free_rate
     
-    def opt_type(self, call_or_put):
+    def opt_type(self, call_or_put, min_maturity=None, max_maturity=None, max_workers: int = 8):
+        # Only expirations inside [min_maturity, max_maturity] are downloaded, concurrently
+        self.expiration_date = self.provider.options(self.ticker_symbol)
+        expirations = [expiration for expiration in self.expiration_date
+                       if (min_maturity is None or pd.to_datetime(expiration) >= pd.to_datetime(min_maturity))
+                       and (max_maturity is None or pd.to_datetime(expiration) <= pd.to_datetime(max_maturity))]
+        if not expirations:
+            raise ValueError(f'{self.ticker_symbol} no tiene vencimientos entre {min_maturity} y {max_maturity}')
+        chains = self.provider.option_chains(self.ticker_symbol, expirations, max_workers=max_workers)
         options = []
-        for expiration in self.expiration_date:
-            options_chain = self.ticker_data.option_chain(expiration)
+        for expiration in expirations:
+            options_chain = chains[expiration]
             if call_or_put == 'Call':
                 option = options_chain.calls
                 self.call_option = True
@@ -41,43 +50,115 @@ class HestonImpliedVolatility():
                 option = options_chain.puts
                 self.call_option = False
             option = option.dropna()
-            option = option[option['volume']  > 10]
+            option = option[option['volume']  > 10].copy()
             option['Maturity'] = expiration
             option['Maturity'] = pd.to_datetime(option['Maturity'])
             option['lastTradeDate'] = pd.to_datetime(option['lastTradeDate']).dt.tz_localize(None)
             option['TTM'] = (pd.to_datetime(option['Maturity']) - option['lastTradeDate']).dt.days / 365.0
             options.append(option)
-            self.option = pd.concat(options, axis=0, ignore_index=True)
+        self.option = pd.concat(options, axis=0, ignore_index=True)
 
-    def get_results(self):
-        trade_dates = self.option['lastTradeDate']
-        start_date, end_date = trade_dates.min(), trade_dates.max()
-        end_date = end_date + timedelta(days = 1)
-        prices = yf.download(self.ticker_symbol, start = start_date, end = end_date, progress = False)['Adj Close'].reset_index()
+    def load_pliq(self, columns, call_or_put, date=None):
+        # Offline alternative to get_risk_free, get_dividend_yield and opt_type: the quotes come from MexDer
+        # PLIQ columns (see PliqLoader) with their own spot and rate per tenor. Every quote's rate is the
+        # file's rate for its own tenor, so European options are discounted exactly as the file states.
+        self.option = PliqLoader.pliq_option_frame(columns, call_or_put, date)
+        self.call_option = call_or_put == 'Call'
+        self.dividend = 0.0
+        self.rf = self.option['Rate'].mean()
+
+    def get_results(self, calibration: str = 'quote', weighting: str = None, workers: int = None, chunk_size: int = 8, progress=None, cache=None, metrics=None,
+                    optimizer_options=None, pricer: str = 'array', store_path: str = None):
+        # calibration: 'quote' fits one parameter set per option, 'maturity' one per maturity slice
+        # and 'surface' a single set for the whole chain. weighting applies to the joint modes only.
+        # workers, chunk_size and progress(done, total) control the per-quote process pool, and a
+        # ParameterCache.HestonParameterCache warm-starts per-quote fits and skips unchanged quotes.
+        # A CalibrationMetrics.CalibrationMetrics collector records what every calibration cost and
+        # optimizer_options (e.g. {'strategy': 'race', 'budget_seconds': 1.0}) bound each per-quote fit.
+        # pricer='fft' prices the joint modes with one Carr-Madan transform per maturity. The results are
+        # kept as a ResultStore.CalibrationResults in self.results and, with store_path, added to the
+        # Parquet history under that directory.
         option = self.option
-        option['lastTradeDate'] = option['lastTradeDate'].apply(lambda x: x.strftime('%Y-%m-%d'))
-        prices['Date'] = prices['Date'].apply(lambda x: x.strftime('%Y-%m-%d'))
-        option = option.merge(prices, left_on = 'lastTradeDate', right_on = 'Date', how = 'left').drop('Date', axis = 1).rename( columns = {'Adj Close':'Price'})
-        option['lastTradeDate'] = option['lastTradeDate'].apply(vol.to_ql_dates)
-        option['Maturity'] = option['Maturity'].apply(vol.to_ql_dates)
+        if 'Price' not in option.columns:
+            trade_dates = option['lastTradeDate']
+            start_date, end_date = trade_dates.min(), trade_dates.max()
+            end_date = end_date + timedelta(days = 1)
+            prices = self.provider.download(self.ticker_symbol, start = start_date, end = end_date)['Adj Close'].reset_index()
+            # Closes are matched to the trade day by serial number
+            prices['Serial'] = MarketEnvironment.ql_serials(prices['Date'])
+            option = option.assign(Serial=MarketEnvironment.ql_serials(option['lastTradeDate']))
+            option = option.merge(prices[['Serial', 'Adj Close']], on = 'Serial', how = 'left').drop('Serial', axis = 1).rename( columns = {'Adj Close':'Price'})
+        else:
+            option = option.copy()
+        # Whole columns are converted to serial numbers at once, the ql.Date objects are built from those
+        calculation_serials = MarketEnvironment.ql_serials(option['lastTradeDate'])
+        maturity_serials = MarketEnvironment.ql_serials(option['Maturity'])
+        option['lastTradeDate'] = MarketEnvironment.ql_dates(calculation_serials)
+        option['Maturity'] = MarketEnvironment.ql_dates(maturity_serials)
+        # Quotes loaded with their own rates (PLIQ) keep them, the rest use the scalar risk free rate
+        rf = option['Rate'].values if 'Rate' in option.columns else self.rf
 
-        spots = option['Price'].values
-        strikes = option['strike'].values
-        mkts = option['lastPrice'].values
-        vols = option['impliedVolatility'].values
-        calc = option['lastTradeDate'].values
-        maturities = option['Maturity'].values
-        ttms = option['TTM'].values
-        rf = self.rf
+        if calibration == 'quote':
+            spots = option['Price'].values
+            strikes = option['strike'].values
+            mkts = option['lastPrice'].values
+            vols = option['impliedVolatility'].values
+            calc = option['lastTradeDate'].values
+            maturities = option['Maturity'].values
+            ttms = option['TTM'].values
 
-        results = [vol.HestonParametersVolatility(spot_price, strike_price, market_price, self.dividend, 
-                                              [.1, .1, historical_volatility, .1, .1], calculation_date, maturity_date, ttm, call_option=self.call_option, risk_free_rate=rf) for 
-        spot_price, strike_price, market_price, historical_volatility, calculation_date, maturity_date, ttm in zip(spots, strikes, mkts, vols, calc, maturities, ttms)]
-        self.results = pd.concat(results)
+            if cache is None:
+                results = [ParallelCalibration.calibrate_quotes(spots, strikes, mkts, vols, calc, maturities, ttms, self.dividend, risk_free_rate=rf,
+                                                                call_option=self.call_option, workers=workers, chunk_size=chunk_size, progress=progress,
+                                                                metrics=metrics, optimizer_options=optimizer_options)]
+            else:
+                results = [ParameterCache.calibrate_quotes_cached(cache, self.ticker_symbol, 'Call' if self.call_option else 'Put', spots, strikes, mkts,
+                                                                  vols, calc, maturities, ttms, self.dividend, risk_free_rate=rf, call_option=self.call_option,
+                                                                  workers=workers, chunk_size=chunk_size, progress=progress, metrics=metrics,
+                                                                  optimizer_options=optimizer_options)]
+        elif calibration in ('maturity', 'surface'):
+            weights = vol.calibration_weights(option, weighting, risk_free_rate=rf, dividend_yield=self.dividend)
+            rates = np.broadcast_to(rf, len(option))
+            groups = pd.Series(maturity_serials).groupby(maturity_serials, sort=False).indices.values() if calibration == 'maturity' else [np.arange(len(option))]
+            results = []
+            positions = []
+            for rows in groups:
+                positions.append(rows)
+                quotes = option.iloc[rows]
+                fitted = vol.HestonSurfaceParametersVolatility(quotes['Price'].values, quotes['strike'].values, quotes['lastPrice'].values, self.dividend,
+                                                               [.1, .1, quotes['impliedVolatility'].mean(), .1, .1], quotes['Maturity'].values,
+                                                               quotes['TTM'].values, risk_free_rate=rates[rows], call_option=self.call_option, weights=weights[rows],
+                                                               metrics=metrics, pricer=pricer)
+                results.append(CalibrationResults.from_frame(fitted).set('Date', calculation_serials[rows]))
+                if progress is not None:
+                    progress(sum(len(result) for result in results), len(option))
+        else:
+            raise ValueError("calibration debe ser 'quote', 'maturity' o 'surface'")
+        self.results = CalibrationResults.concat(results)
+        if store_path is not None:
+            self.results.save(store_path, self.ticker_symbol, 'Call' if self.call_option else 'Put')
         self.table = vol.calculate_expected_variance_over_strikes(self.results)
+        # Black volatility implied by each Heston price, inverted for the whole chain at once
+        rows = np.arange(len(option)) if calibration == 'quote' else np.concatenate(positions)
+        self.table['Black_Volatility'] = bs.implied_volatility(self.table['Theorical_Price'].values, option['Price'].values[rows],
+                                                               self.table['Strike'].values, self.table['TTM'].values,
+                                                               np.broadcast_to(rf, len(option))[rows], self.dividend, self.call_option)
+        try:
+            self.build_surface()
+        except Exception as e:
+            print('Volatility surface could not be built:', e)
+            self.surface = None
         return self.table
     
+    def build_surface(self, method: str = 'svi'):
+        # Smoothed, queryable surface of the Black volatilities in the results table
+        self.surface = VolatilitySurface.from_table(self.table, method=method)
+        return self.surface
+
     def volatility_surface(self):
+        # Drawn from the surface grid when one could be built, from the raw points otherwise
+        if getattr(self, 'surface', None) is not None:
+            return self.surface.figure()
         fig = Graphs.vol_surface(self.table)
         return fig
 
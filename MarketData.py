@@ -0,0 +1,142 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from types import SimpleNamespace
+import yfinance as yf
+import pandas as pd
+import hashlib
+import glob
+import time
+import os
+import re
+
+class MarketDataProvider():
+    # Single entry point for every yfinance request. Responses are stored as Parquet files in cache_dir
+    # and served from there while they are younger than ttl seconds. In offline mode only the cache is
+    # used, whatever its age, so a day can be replayed without network access. cache_dir is only created
+    # when the first response is stored.
+    def __init__(self, cache_dir='market_data_cache', ttl: float = 15 * 60, offline: bool = False):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.offline = offline
+
+    def cache_path(self, kind, *key):
+        name = '_'.join([kind] + [str(k) for k in key if k is not None])
+        return os.path.join(self.cache_dir, re.sub(r'[^A-Za-z0-9_.=-]', '-', name) + '.parquet')
+
+    def option_files(self, ticker):
+        # Cached expiration list and option chains of ticker
+        chains = self.cache_path('option_chain', ticker)[:-len('.parquet')] + '_*.parquet'
+        return [path for path in [self.cache_path('options', ticker)] + sorted(glob.glob(chains)) if os.path.exists(path)]
+
+    def snapshot(self, ticker):
+        # Identifies the cached data of ticker (prices, dividends, expirations and chains, plus the risk
+        # free rate): a hash of the files' names, sizes and modification times. It only changes when a
+        # download rewrites one of them.
+        name = re.sub(r'[^A-Za-z0-9_.=-]', '-', str(ticker))
+        paths = glob.glob(os.path.join(self.cache_dir, f'*_{name}.parquet')) + glob.glob(os.path.join(self.cache_dir, f'*_{name}_*.parquet'))
+        paths.append(self.cache_path('download', '^IRX', None, None, '1d'))
+        digest = hashlib.sha1()
+        for path in sorted(set(paths)):
+            if os.path.exists(path):
+                stat = os.stat(path)
+                digest.update(f'{os.path.basename(path)}|{stat.st_size}|{stat.st_mtime_ns};'.encode())
+        return digest.hexdigest()
+
+    def fresh(self, ticker):
+        # Whether the option data of ticker would be served from the cache right now, without downloads
+        paths = self.option_files(ticker)
+        return bool(paths) and (self.offline or all(time.time() - os.path.getmtime(path) < self.ttl for path in paths))
+
+    def cached(self, path, fetch):
+        if os.path.exists(path) and (self.offline or time.time() - os.path.getmtime(path) < self.ttl):
+            return pd.read_parquet(path)
+        if self.offline:
+            raise FileNotFoundError(f'{os.path.basename(path)} no está en la caché y el modo offline está activo')
+        data = fetch()
+        # yfinance answers failed requests with empty frames, which must not be cached
+        if len(data):
+            os.makedirs(self.cache_dir, exist_ok=True)
+            data.to_parquet(path)
+        return data
+
+    def download(self, ticker, start=None, end=None, period=None):
+        # Same as yf.download for a single ticker, with one level of columns ('Open', ..., 'Adj Close')
+        start = None if start is None else pd.Timestamp(start).strftime('%Y-%m-%d')
+        end = None if end is None else pd.Timestamp(end).strftime('%Y-%m-%d')
+
+        def fetch():
+            data = yf.download(ticker, start=start, end=end, period=period, progress=False, auto_adjust=False)
+            if isinstance(data.columns, pd.MultiIndex):
+                data.columns = data.columns.get_level_values(0)
+            return data
+
+        return self.cached(self.cache_path('download', ticker, start, end, period), fetch)
+
+    def spot_price(self, ticker, date=None):
+        # Adjusted close in the three days before date (today by default). Offline, a day that is not in
+        # the cache falls back to the latest price download cached for ticker, so the day it was saved on
+        # can be replayed later.
+        end = pd.Timestamp.today().normalize() if date is None else pd.Timestamp(date)
+        try:
+            prices = self.download(ticker, start=end - timedelta(days = 3), end=end)
+        except FileNotFoundError:
+            pattern = self.cache_path('download', ticker)[:-len('.parquet')] + '_*.parquet'
+            paths = glob.glob(pattern)
+            if not paths:
+                raise
+            prices = pd.read_parquet(max(paths, key=os.path.getmtime))
+        return prices['Adj Close'].iloc[0]
+
+    def history(self, ticker, start=None, end=None, period=None):
+        start = None if start is None else pd.Timestamp(start).strftime('%Y-%m-%d')
+        end = None if end is None else pd.Timestamp(end).strftime('%Y-%m-%d')
+        return self.cached(self.cache_path('history', ticker, start, end, period),
+                           lambda: yf.Ticker(ticker).history(period=period, start=start, end=end))
+
+    def dividends(self, ticker):
+        return self.cached(self.cache_path('dividends', ticker), lambda: yf.Ticker(ticker).dividends.to_frame())['Dividends']
+
+    def options(self, ticker):
+        expirations = self.cached(self.cache_path('options', ticker),
+                                  lambda: pd.DataFrame({'expiration': list(yf.Ticker(ticker).options)}))
+        return tuple(expirations['expiration'])
+
+    def option_chain(self, ticker, expiration):
+        def fetch():
+            chain = yf.Ticker(ticker).option_chain(expiration)
+            return pd.concat([chain.calls.assign(side='calls'), chain.puts.assign(side='puts')], ignore_index=True)
+
+        chain = self.cached(self.cache_path('option_chain', ticker, expiration), fetch)
+        calls = chain[chain['side'] == 'calls'].drop(columns='side').reset_index(drop=True)
+        puts = chain[chain['side'] == 'puts'].drop(columns='side').reset_index(drop=True)
+        return SimpleNamespace(calls=calls, puts=puts)
+
+    def option_chains(self, ticker, expirations, max_workers: int = 8, retries: int = 3, backoff: float = 0.5):
+        # Downloads several expirations at once with at most max_workers requests in flight. Failed
+        # requests are retried with exponential backoff; a cache miss in offline mode is not retried.
+        def fetch(expiration):
+            for attempt in range(retries + 1):
+                try:
+                    return self.option_chain(ticker, expiration)
+                except FileNotFoundError:
+                    raise
+                except Exception:
+                    if attempt == retries:
+                        raise
+                    time.sleep(backoff * 2 ** attempt)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return dict(zip(expirations, executor.map(fetch, expirations)))
+
+    def risk_free_rate(self):
+        # 13-week T-bill yield
+        return self.download('^IRX', period='1d')['Close'].iloc[-1] / 100
+
+    def dividend_yield(self, ticker):
+        # Last dividend annualized (quarterly payments) over the close on the dividend date
+        dividends = self.dividends(ticker)
+        last_dividend = dividends.iloc[-1] * 4
+        dividend_date = dividends.index[-1]
+        end_date = dividend_date + timedelta(days = 3)
+        price_in_div_date = self.history(ticker, period='1d', start=dividend_date, end=end_date)['Close'].iloc[0]
+        return last_dividend / price_in_div_date
@@ -0,0 +1,62 @@
+from collections import OrderedDict
+import QuantLib as ql
+import pandas as pd
+import numpy as np
+import threading
+
+# Shared market environment. Flat curves are built once per (valuation date, rate) and
+# handed out as shared YieldTermStructureHandles, so repricing a chain does not rebuild a term structure
+# per contract. Dates are converted between pandas/NumPy and QuantLib as whole columns of serial
+# numbers (days since 1899-12-30, QuantLib's and Excel's convention).
+
+QL_EPOCH = np.datetime64('1899-12-30', 'D')
+
+def ql_serials(dates):
+    # Serial numbers of a column of dates (anything pandas parses), time of day dropped
+    values = pd.to_datetime(pd.Series(np.asarray(dates).ravel())).dt.tz_localize(None).values.astype('datetime64[D]')
+    return (values - QL_EPOCH).astype('int64')
+
+def ql_dates(dates):
+    # List of ql.Date from a column of dates or serial numbers; one object per distinct date, shared by
+    # every row with that date
+    serials = np.asarray(dates)
+    serials = serials if np.issubdtype(serials.dtype, np.integer) else ql_serials(serials)
+    unique, inverse = np.unique(serials, return_inverse=True)
+    objects = [ql.Date(int(serial)) for serial in unique]
+    return [objects[i] for i in inverse.ravel()]
+
+def year_fractions(start_dates, end_dates):
+    # Actual/365 (Fixed) year fractions, the convention every pricer in the package uses
+    return (ql_serials(end_dates) - ql_serials(start_dates)) / 365.0
+
+class MarketEnvironment():
+    def __init__(self, max_entries: int = 4096):
+        self.day_count = ql.Actual365Fixed()
+        self.max_entries = max_entries
+        self.curves = OrderedDict()
+        # Shared by every thread pricing with this environment
+        self.lock = threading.Lock()
+
+    def cached(self, key, build):
+        with self.lock:
+            if key in self.curves:
+                self.curves.move_to_end(key)
+                return self.curves[key]
+            curve = build()
+            self.curves[key] = curve
+            if len(self.curves) > self.max_entries:
+                self.curves.popitem(last=False)
+            return curve
+
+    def flat_curve(self, calculation_date, rate):
+        # Continuously compounded flat curve; used for rates and dividend yields alike
+        rate = float(rate)
+        return self.cached(('flat', calculation_date.serialNumber(), rate),
+                           lambda: ql.YieldTermStructureHandle(ql.FlatForward(calculation_date, rate, self.day_count)))
+
+    def clear(self):
+        with self.lock:
+            self.curves.clear()
+
+# Environment shared by HestonNPV and the calibration contexts of this process
+default_environment = MarketEnvironment()
@@ -0,0 +1,145 @@
+from concurrent.futures import ProcessPoolExecutor
+from scipy.stats import norm
+import PricesFunctions as pr
+import numpy as np
+import time
+
+# Heston path simulation. params is the [v0, kappa, theta, sigma, rho] list HestonParametersVolatility
+# returns in its Params column. Paths are generated chunk by chunk, so memory is bounded by chunk_size
+# whatever the number of paths, and every chunk draws from its own child of one SeedSequence, so a run
+# gives the same numbers with any number of workers.
+
+SCHEMES = ['QE', 'Euler']
+
+def qe_step(log_spot, v, dt, drift, kappa, theta, sigma, rho, z_v, z_s, psi_c=1.5):
+    # Andersen's quadratic-exponential step for the variance with the central (gamma1 = gamma2 = 1/2)
+    # discretization of the log spot and its martingale correction
+    decay = np.exp(-kappa * dt)
+    m = theta + (v - theta) * decay
+    s2 = v * sigma ** 2 * decay / kappa * (1 - decay) + theta * sigma ** 2 / (2 * kappa) * (1 - decay) ** 2
+    psi = s2 / np.maximum(m, 1e-300) ** 2
+    quadratic = psi <= psi_c
+
+    # Quadratic branch: v' = a (b + Z)^2
+    inverse = 2 / np.where(quadratic, psi, 1.0)
+    b2 = np.where(quadratic, inverse - 1 + np.sqrt(inverse) * np.sqrt(np.maximum(inverse - 1, 0.0)), 0.0)
+    a = m / (1 + b2)
+    # Exponential branch: point mass p at zero and an exponential tail with rate beta
+    p = np.where(quadratic, 0.0, (psi - 1) / (psi + 1))
+    beta = (1 - p) / np.maximum(m, 1e-300)
+    u = norm.cdf(z_v)
+    tail = np.log(np.maximum(1 - p, 1e-300) / np.maximum(1 - u, 1e-300)) / beta
+    v_next = np.where(quadratic, a * (np.sqrt(b2) + z_v) ** 2, np.where(u <= p, 0.0, tail))
+
+    k1 = 0.5 * dt * (kappa * rho / sigma - 0.5) - rho / sigma
+    k2 = 0.5 * dt * (kappa * rho / sigma - 0.5) + rho / sigma
+    k3 = k4 = 0.5 * dt * (1 - rho ** 2)
+    big_a = k2 + 0.5 * k4
+    with np.errstate(divide='ignore', invalid='ignore'):
+        k0_quadratic = -big_a * b2 * a / (1 - 2 * big_a * a) + 0.5 * np.log(1 - 2 * big_a * a)
+        k0_exponential = -np.log(p + beta * (1 - p) / (beta - big_a))
+    k0 = np.where(quadratic, k0_quadratic, k0_exponential) - (k1 + 0.5 * k3) * v
+    # Without a finite moment for the correction fall back to the plain drift
+    k0 = np.where(np.isfinite(k0), k0, -rho * kappa * theta / sigma * dt)
+    log_spot = log_spot + drift * dt + k0 + k1 * v + k2 * v_next + np.sqrt(np.maximum(k3 * v + k4 * v_next, 0.0)) * z_s
+    return log_spot, v_next
+
+def euler_step(log_spot, v, dt, drift, kappa, theta, sigma, rho, z_v, z_s):
+    # Full truncation: the variance may go negative, only its positive part enters drift and diffusion
+    v_plus = np.maximum(v, 0.0)
+    log_spot = log_spot + (drift - 0.5 * v_plus) * dt + np.sqrt(v_plus * dt) * (rho * z_v + np.sqrt(1 - rho ** 2) * z_s)
+    v = v + kappa * (theta - v_plus) * dt + sigma * np.sqrt(v_plus * dt) * z_v
+    return log_spot, v
+
+def simulate_heston_paths(params, spot_price, risk_free_rate, dividend_yield, ttm, n_paths, steps=100, rng=None,
+                          scheme='QE', antithetic=False):
+    # Spot and variance paths, both (n_paths, steps + 1). With antithetic=True the second half of the
+    # paths reuses the normals of the first half with the opposite sign.
+    if scheme not in SCHEMES:
+        raise ValueError(f'scheme debe ser uno de {SCHEMES}')
+    v0, kappa, theta, sigma, rho = [float(p) for p in params]
+    rng = np.random.default_rng() if rng is None else rng
+    dt = ttm / steps
+    drift = risk_free_rate - dividend_yield
+    step = qe_step if scheme == 'QE' else euler_step
+    half = (n_paths + 1) // 2 if antithetic else n_paths
+
+    log_spot = np.full(n_paths, np.log(spot_price))
+    v = np.full(n_paths, v0)
+    spots, variances = np.empty((n_paths, steps + 1)), np.empty((n_paths, steps + 1))
+    spots[:, 0], variances[:, 0] = spot_price, v0
+    for i in range(1, steps + 1):
+        z = rng.standard_normal((2, half))
+        if antithetic:
+            z = np.concatenate([z, -z], axis=1)[:, :n_paths]
+        log_spot, v = step(log_spot, v, dt, drift, kappa, theta, sigma, rho, z[0], z[1])
+        spots[:, i], variances[:, i] = np.exp(log_spot), np.maximum(v, 0.0)
+    return spots, variances
+
+def european_payoff(spot_paths, strike_price, call_option=True):
+    terminal = spot_paths[:, -1]
+    return np.maximum(terminal - strike_price, 0.0) if call_option else np.maximum(strike_price - terminal, 0.0)
+
+def asian_payoff(spot_paths, strike_price, call_option=True):
+    # Arithmetic average over the monitoring dates, the initial spot excluded
+    average = spot_paths[:, 1:].mean(axis=1)
+    return np.maximum(average - strike_price, 0.0) if call_option else np.maximum(strike_price - average, 0.0)
+
+def simulate_chunk(params, spot_price, strike_price, risk_free_rate, dividend_yield, ttm, n_paths, steps, seed_sequence,
+                   scheme, antithetic, payoff, call_option):
+    # Runs inside the workers and returns only the sums the estimator needs: count, sum and sum of
+    # squares of the discounted payoff Y and of the discounted European control X, and the sum of X * Y.
+    # Antithetic pairs are averaged first, so each pair counts as one independent sample.
+    rng = np.random.default_rng(seed_sequence)
+    spots, _ = simulate_heston_paths(params, spot_price, risk_free_rate, dividend_yield, ttm, n_paths, steps, rng,
+                                     scheme, antithetic)
+    discount = np.exp(-risk_free_rate * ttm)
+    y = discount * payoff(spots, strike_price, call_option)
+    x = discount * european_payoff(spots, strike_price, call_option)
+    if antithetic:
+        # Path j is paired with path half + j; an odd chunk leaves its last original path unpaired
+        pairs, half = n_paths // 2, (n_paths + 1) // 2
+        y = np.concatenate([0.5 * (y[:pairs] + y[half:half + pairs]), y[pairs:half]])
+        x = np.concatenate([0.5 * (x[:pairs] + x[half:half + pairs]), x[pairs:half]])
+    return np.array([len(y), y.sum(), (y ** 2).sum(), x.sum(), (x ** 2).sum(), (x * y).sum()])
+
+def HestonMonteCarlo(params, spot_price, strike_price, risk_free_rate, dividend_yield, ttm, payoff=european_payoff,
+                     call_option=True, n_paths=100000, steps=100, chunk_size=10000, seed=None, scheme='QE',
+                     antithetic=False, control_variate=False, workers=None):
+    # Monte Carlo price of payoff(spot_paths, strike_price, call_option) under Heston. With
+    # control_variate=True the discounted European payoff on the same paths is the control, its mean
+    # being the analytic HestonNPVArray price. workers=None (or 1) simulates the chunks in this process,
+    # otherwise they are spread over a process pool (payoff must then be a module-level function).
+    chunks = [min(chunk_size, n_paths - start) for start in range(0, n_paths, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+    arguments = [(params, spot_price, strike_price, risk_free_rate, dividend_yield, ttm, n, steps, child, scheme,
+                  antithetic, payoff, call_option) for n, child in zip(chunks, seeds)]
+
+    start = time.perf_counter()
+    if workers is None or workers <= 1:
+        sums = [simulate_chunk(*args) for args in arguments]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            sums = list(executor.map(simulate_chunk, *zip(*arguments)))
+    seconds = time.perf_counter() - start
+
+    n, sum_y, sum_yy, sum_x, sum_xx, sum_xy = np.sum(sums, axis=0)
+    mean_y, mean_x = sum_y / n, sum_x / n
+    var_y = max(sum_yy / n - mean_y ** 2, 0.0) * n / max(n - 1, 1)
+    price, variance, beta = mean_y, var_y, None
+    if control_variate:
+        v0, kappa, theta, sigma, rho = [float(p) for p in params]
+        control = float(pr.HestonNPVArray(v0, kappa, theta, sigma, rho, risk_free_rate, dividend_yield, ttm, spot_price,
+                                          strike_price, call_option))
+        var_x = max(sum_xx / n - mean_x ** 2, 0.0) * n / max(n - 1, 1)
+        cov_xy = (sum_xy / n - mean_x * mean_y) * n / max(n - 1, 1)
+        beta = cov_xy / var_x if var_x > 0 else 0.0
+        price = mean_y - beta * (mean_x - control)
+        variance = max(var_y - beta * cov_xy, 0.0)
+
+    return {'Price': float(price),
+            'Standard_Error': float(np.sqrt(variance / n)),
+            'Paths': n_paths,
+            'Seconds': seconds,
+            'Paths_per_Second': n_paths / seconds if seconds > 0 else np.inf,
+            'Control_Beta': None if beta is None else float(beta)}
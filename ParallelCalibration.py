@@ -0,0 +1,99 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from CalibrationContext import HestonCalibrationContext
+from CalibrationMetrics import CalibrationMetrics
+from ResultStore import CalibrationResults
+import VolatilityFunctions as vol
+import QuantLib as ql
+import numpy as np
+
+def failed_row(strike_price, ttm):
+    return {'Optimizer': 'None', 'Success': False, 'Params': None, 'Strike': strike_price, 'TTM': ttm,
+            'Objective_Value': None, 'Estimated_Price': None, 'Market_Price': None, 'Residual': None, 'MSE': None, 'Seconds': None}
+
+def calibrate_chunk(quotes, dividend_yield, call_option, collect_metrics=False, optimizer_options=None):
+    # Runs inside the worker processes. QuantLib objects can not be pickled, so every quote arrives as
+    # plain numbers with the dates as QuantLib serial numbers and the chunk leaves as one
+    # CalibrationResults without the dates, which the parent process fills in. With collect_metrics the calibration records
+    # are returned too, for the parent to merge into its collector. optimizer_options (strategy,
+    # budget_seconds, max_evaluations, tolerance) go straight to HestonParametersVolatility.
+    rows = []
+    metrics = CalibrationMetrics() if collect_metrics else None
+    optimizer_options = {} if optimizer_options is None else optimizer_options
+    # Quotes with the same dates and spot share one calibration context
+    contexts = {}
+    for spot_price, strike_price, market_price, historical_volatility, calculation_serial, maturity_serial, ttm, risk_free_rate, initial_params in quotes:
+        try:
+            calculation_date, maturity_date = ql.Date(int(calculation_serial)), ql.Date(int(maturity_serial))
+            key = (calculation_serial, maturity_serial, spot_price, risk_free_rate)
+            if key not in contexts:
+                contexts[key] = HestonCalibrationContext(calculation_date, maturity_date, spot_price, dividend_yield, risk_free_rate, call_option)
+            # Warm starts keep the bounds of a cold start around the historical volatility
+            bounds = vol.heston_bounds(historical_volatility)
+            if initial_params is None:
+                initial_params = [.1, .1, historical_volatility, .1, .1]
+            initial_params = [min(max(p, low), high) for p, (low, high) in zip(initial_params, bounds)]
+            result = vol.HestonParametersVolatility(spot_price, strike_price, market_price, dividend_yield,
+                                                    initial_params, calculation_date,
+                                                    maturity_date, ttm, call_option=call_option, risk_free_rate=risk_free_rate,
+                                                    context=contexts[key], bounds=bounds, metrics=metrics, as_frame=False,
+                                                    **optimizer_options)
+            result.pop('Maturity')
+        except Exception as e:
+            print('Calibration failed for strike', strike_price, 'with the following error:', e)
+            result = failed_row(strike_price, ttm)
+        rows.append(result)
+    return CalibrationResults(len(rows)).append_rows(rows), [] if metrics is None else metrics.records
+
+def calibrate_quotes(spots, strikes, market_prices, historical_volatilities, calculation_dates, maturity_dates, ttms,
+                     dividend_yield, risk_free_rate=0.00525, call_option=True, workers=None, chunk_size=8, progress=None,
+                     initial_params=None, metrics=None, optimizer_options=None):
+    # Calibrates every quote with HestonParametersVolatility, starting from initial_params[i] when given
+    # (None entries fall back to the default guess). risk_free_rate is a scalar or one rate per quote. workers=None (or 1) runs in this process,
+    # otherwise the quotes are split in chunks of chunk_size and spread over a process pool. QuantLib holds
+    # the GIL and every price runs under EVALUATION_LOCK, so a thread pool would be no faster than the
+    # serial loop; calibrate_quotes is still safe to call from threads, such as the app's jobs. Rows keep the
+    # input order either way, a failing quote or worker becomes a failed row and progress(done, total)
+    # is called every time a chunk finishes. A CalibrationMetrics collector receives the records of every
+    # quote, in input order. optimizer_options select the optimizer strategy and budgets per quote.
+    # Returns a ResultStore.CalibrationResults.
+    calculation_serials = [date.serialNumber() for date in calculation_dates]
+    maturity_serials = [date.serialNumber() for date in maturity_dates]
+    if initial_params is None:
+        initial_params = [None] * len(calculation_serials)
+    initial_params = [None if params is None else [float(p) for p in params] for params in initial_params]
+    quotes = list(zip(np.asarray(spots, dtype=float), np.asarray(strikes, dtype=float), np.asarray(market_prices, dtype=float),
+                      np.asarray(historical_volatilities, dtype=float), calculation_serials, maturity_serials, np.asarray(ttms, dtype=float),
+                      np.broadcast_to(np.asarray(risk_free_rate, dtype=float), len(calculation_serials)), initial_params))
+    total = len(quotes)
+    chunks = [quotes[start:start + chunk_size] for start in range(0, total, chunk_size)]
+    stores = [None] * len(chunks)
+    records = [None] * len(chunks)
+    collect_metrics = metrics is not None
+    done = 0
+
+    if workers is None or workers <= 1:
+        for i, chunk in enumerate(chunks):
+            stores[i], records[i] = calibrate_chunk(chunk, dividend_yield, call_option, collect_metrics, optimizer_options)
+            done += len(chunk)
+            if progress is not None:
+                progress(done, total)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(calibrate_chunk, chunk, dividend_yield, call_option, collect_metrics, optimizer_options): (i, chunk)
+                       for i, chunk in enumerate(chunks)}
+            for future in as_completed(futures):
+                i, chunk = futures[future]
+                try:
+                    stores[i], records[i] = future.result()
+                except Exception as e:
+                    print('Calibration worker failed with the following error:', e)
+                    stores[i], records[i] = CalibrationResults(len(chunk)).append_rows([failed_row(quote[1], quote[6]) for quote in chunk]), []
+                done += len(chunk)
+                if progress is not None:
+                    progress(done, total)
+
+    if collect_metrics:
+        for chunk_records in records:
+            metrics.extend(chunk_records)
+    results = CalibrationResults.concat(stores)
+    return results.set('Maturity', maturity_serials).set('Date', calculation_serials)
@@ -0,0 +1,107 @@
+import ParallelCalibration
+import sqlite3
+import time
+import os
+import numpy as np
+
+class HestonParameterCache():
+    # On-disk store of the last good Heston parameters per (ticker, option type, maturity, strike).
+    # Entries older than max_age seconds are ignored and dropped, and once the store holds more than
+    # max_entries rows the least recently updated ones are evicted. Quotes whose market price and spot
+    # moved less than price_threshold and spot_threshold (relative) reuse their cached result.
+    def __init__(self, path='heston_parameters.sqlite', max_entries: int = 100000, max_age: float = 7 * 24 * 3600,
+                 price_threshold: float = 0.01, spot_threshold: float = 0.005):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.price_threshold = price_threshold
+        self.spot_threshold = spot_threshold
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self.connect() as connection:
+            connection.execute('''CREATE TABLE IF NOT EXISTS heston_parameters (
+                                      ticker TEXT, option_type TEXT, maturity TEXT, strike REAL,
+                                      v0 REAL, kappa REAL, theta REAL, sigma REAL, rho REAL,
+                                      market_price REAL, spot_price REAL, estimated_price REAL, updated REAL,
+                                      PRIMARY KEY (ticker, option_type, maturity, strike))''')
+            connection.execute('CREATE INDEX IF NOT EXISTS heston_parameters_updated ON heston_parameters (updated)')
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get_many(self, ticker, option_type, maturities, strikes):
+        # Returns one dict (or None) per (maturity, strike) pair, in order
+        oldest = time.time() - self.max_age
+        with self.connect() as connection:
+            rows = connection.execute('''SELECT maturity, strike, v0, kappa, theta, sigma, rho, market_price, spot_price, estimated_price
+                                         FROM heston_parameters WHERE ticker = ? AND option_type = ? AND updated >= ?''',
+                                      (ticker, option_type, oldest)).fetchall()
+        entries = {(row[0], row[1]): {'params': list(row[2:7]), 'market_price': row[7], 'spot_price': row[8], 'estimated_price': row[9]}
+                   for row in rows}
+        return [entries.get((maturity, float(strike))) for maturity, strike in zip(maturities, strikes)]
+
+    def put_many(self, ticker, option_type, maturities, strikes, params, market_prices, spot_prices, estimated_prices):
+        now = time.time()
+        records = [(ticker, option_type, maturity, float(strike), *[float(p) for p in param], float(market_price), float(spot_price),
+                    float(estimated_price), now)
+                   for maturity, strike, param, market_price, spot_price, estimated_price
+                   in zip(maturities, strikes, params, market_prices, spot_prices, estimated_prices)]
+        with self.connect() as connection:
+            connection.executemany('INSERT OR REPLACE INTO heston_parameters VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', records)
+            self.evict(connection, now)
+
+    def evict(self, connection, now=None):
+        now = time.time() if now is None else now
+        connection.execute('DELETE FROM heston_parameters WHERE updated < ?', (now - self.max_age,))
+        connection.execute('''DELETE FROM heston_parameters WHERE rowid IN (
+                                  SELECT rowid FROM heston_parameters ORDER BY updated DESC LIMIT -1 OFFSET ?)''', (self.max_entries,))
+
+    def clear(self):
+        with self.connect() as connection:
+            connection.execute('DELETE FROM heston_parameters')
+
+def is_unchanged(entry, market_price, spot_price, price_threshold=0.01, spot_threshold=0.005):
+    # A cached result is reused outright when both the option and the underlying moved less than the
+    # relative thresholds since it was calibrated
+    if entry is None:
+        return False
+    price_move = abs(market_price - entry['market_price']) / max(abs(entry['market_price']), 1e-8)
+    spot_move = abs(spot_price - entry['spot_price']) / max(abs(entry['spot_price']), 1e-8)
+    return price_move <= price_threshold and spot_move <= spot_threshold
+
+def calibrate_quotes_cached(cache, ticker, option_type, spots, strikes, market_prices, historical_volatilities, calculation_dates,
+                            maturity_dates, ttms, dividend_yield, risk_free_rate=0.00525, call_option=True, **executor_options):
+    # Incremental version of ParallelCalibration.calibrate_quotes: unchanged quotes reuse their cached
+    # result, the rest are recalibrated starting from their cached parameters when available and the
+    # successful fits are written back to the cache.
+    spots, strikes, market_prices, historical_volatilities, ttms = [np.asarray(a, dtype=float) for a in
+                                                                     (spots, strikes, market_prices, historical_volatilities, ttms)]
+    calculation_dates, maturity_dates = list(calculation_dates), list(maturity_dates)
+    rates = np.broadcast_to(np.asarray(risk_free_rate, dtype=float), len(market_prices))
+    maturities = [date.ISO() for date in maturity_dates]
+    entries = cache.get_many(ticker, option_type, maturities, strikes)
+    reuse = np.array([is_unchanged(entry, market_price, spot_price, cache.price_threshold, cache.spot_threshold)
+                      for entry, market_price, spot_price in zip(entries, market_prices, spots)], dtype=bool)
+    stale = np.flatnonzero(~reuse)
+
+    results = ParallelCalibration.calibrate_quotes(spots[stale], strikes[stale], market_prices[stale], historical_volatilities[stale],
+                                                   [calculation_dates[i] for i in stale], [maturity_dates[i] for i in stale], ttms[stale],
+                                                   dividend_yield, risk_free_rate=rates[stale], call_option=call_option,
+                                                   initial_params=[None if entries[i] is None else entries[i]['params'] for i in stale],
+                                                   **executor_options)
+
+    reused = np.flatnonzero(reuse)
+    if len(reused):
+        estimated_prices = np.array([entries[i]['estimated_price'] for i in reused], dtype=float)
+        residuals = estimated_prices - market_prices[reused]
+        results.append(len(reused), Optimizer='Cache', Success=True, Params=np.array([entries[i]['params'] for i in reused], dtype=float),
+                       Strike=strikes[reused], TTM=ttms[reused], Maturity=[maturity_dates[i].serialNumber() for i in reused],
+                       Date=[calculation_dates[i].serialNumber() for i in reused], Objective_Value=residuals ** 2,
+                       Estimated_Price=estimated_prices, Market_Price=market_prices[reused], Residual=residuals, MSE=residuals ** 2, Seconds=0.0)
+
+    fitted = results['Success'][:len(stale)]
+    if fitted.any():
+        cache.put_many(ticker, option_type, [maturities[i] for i in stale[fitted]], strikes[stale[fitted]], results.params()[:len(stale)][fitted],
+                       market_prices[stale[fitted]], spots[stale[fitted]], results['Estimated_Price'][:len(stale)][fitted])
+    # Back to the input order: the recalibrated quotes come first in results, the reused ones after them
+    return results.take(np.argsort(np.concatenate([stale, reused]), kind='stable'))
@@ -0,0 +1,188 @@
+import pandas as pd
+import numpy as np
+import glob
+import io
+import os
+import re
+
+# MexDer settlement (PLIQ) files. The CSV carries a UTF-8 BOM and a trailing blank header field, the H
+# file has no header and pads the strikes and prices with spaces. Both are read with pandas' C parser
+# straight into typed NumPy columns; nothing is processed row by row.
+PLIQ_CSV_COLUMNS = {'Fecha': 'int64', 'TV': 'U4', 'Emisora': 'U8', 'Serie': 'float64', 'Vencimiento': 'U1',
+                    'Tasa de Interes': 'float64', 'Plazo a Vencimiento': 'float64', 'Futuro': 'float64', 'Pliq': 'float64',
+                    'Bid': 'float64', 'Ask': 'float64', 'Call o Put': 'int8', 'Hubo Bid/Ask': 'int8', 'Volatilidad': 'float64',
+                    'V. Teorico': 'float64'}
+PLIQ_H_COLUMNS = {'Emisora': 'U8', 'Serie': 'float64', 'Vencimiento': 'U1', 'Pliq': 'float64', 'Volatilidad': 'float64'}
+
+# Series letters: A-L are calls expiring January-December, M-X the puts for the same months
+SERIES_CALLS = list('ABCDEFGHIJKL')
+
+def pliq_date(path):
+    # Trade date from the YYYYMMDD_PLIQ_* file name
+    return np.datetime64(pd.to_datetime(re.match(r'(\d{8})', os.path.basename(path)).group(1), format='%Y%m%d').date(), 'D')
+
+def int_to_dates(values):
+    values = np.asarray(values, dtype='int64')
+    years = (values // 10000 - 1970).astype('datetime64[Y]')
+    months = (years.astype('datetime64[M]') + (values // 100 % 100 - 1).astype('timedelta64[M]'))
+    return months.astype('datetime64[D]') + (values % 100 - 1).astype('timedelta64[D]')
+
+def file_kind(path):
+    return 'txt' if path.endswith('.txt') else 'csv'
+
+def file_body(path):
+    # Raw rows of one file without BOM, header line or trailing blank lines
+    raw = open(path, 'rb').read()
+    if raw.startswith(b'\xef\xbb\xbf'):
+        raw = raw[3:]
+    if file_kind(path) == 'csv':
+        raw = raw.split(b'\n', 1)[1] if b'\n' in raw else b''
+    raw = raw.rstrip(b'\r\n \t')
+    return raw + b'\n' if raw else b''
+
+def read_pliq_files(paths):
+    # Parses several files of the same kind with a single pass of the C parser over their concatenated
+    # rows, which is what makes whole directories of small daily files cheap. Returns the columns and the
+    # number of rows each file contributed.
+    kind = file_kind(paths[0])
+    dtypes = PLIQ_H_COLUMNS if kind == 'txt' else PLIQ_CSV_COLUMNS
+    bodies = [file_body(path) for path in paths]
+    counts = np.array([body.count(b'\n') for body in bodies])
+    frame = pd.read_csv(io.BytesIO(b''.join(bodies)), header=None, names=list(dtypes), usecols=range(len(dtypes)),
+                        skipinitialspace=True, skip_blank_lines=False, engine='c',
+                        dtype={name: (str if dtype.startswith('U') else 'float64') for name, dtype in dtypes.items()})
+    columns = {}
+    for name, dtype in dtypes.items():
+        if dtype.startswith('U'):
+            columns[name] = frame[name].fillna('').to_numpy(dtype=dtype)
+        elif dtype.startswith('float'):
+            columns[name] = frame[name].to_numpy(dtype=dtype, na_value=np.nan)
+        else:
+            columns[name] = frame[name].fillna(0).to_numpy(dtype=dtype)
+    if kind == 'txt':
+        # H files carry the trade date only in their name
+        columns['Fecha'] = np.repeat(np.array([pliq_date(path) for path in paths]), counts)
+    else:
+        columns['Fecha'] = int_to_dates(columns['Fecha'])
+    return columns, counts
+
+def read_pliq(path):
+    return read_pliq_files([path])[0]
+
+def to_records(columns):
+    records = np.empty(len(next(iter(columns.values()))), dtype=[(name, values.dtype) for name, values in columns.items()])
+    for name, values in columns.items():
+        records[name] = values
+    return records
+
+def cache_entry(path, cache_dir):
+    stat = os.stat(path)
+    return os.path.join(cache_dir, f'{os.path.basename(path)}.{stat.st_size}.{stat.st_mtime_ns}.npy')
+
+def iter_pliq_directory(directory, pattern='*_PLIQ_*', cache_dir=None, batch_size=64):
+    # Streams the matching files in date order, batch_size files at a time, as (paths, columns). With a
+    # cache_dir every parsed file is also stored as one structured .npy array, keyed by name, size and
+    # modification time, and later reads memory-map it instead of parsing the text again.
+    paths = sorted(path for path in glob.glob(os.path.join(directory, pattern)) if path.endswith(('.csv', '.txt')))
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+    for start in range(0, len(paths), batch_size):
+        batch = paths[start:start + batch_size]
+        parts = []
+        for kind in ('csv', 'txt'):
+            files = [path for path in batch if file_kind(path) == kind]
+            cached = [path for path in files if cache_dir is not None and os.path.exists(cache_entry(path, cache_dir))]
+            missing = [path for path in files if path not in cached]
+            records = {path: np.load(cache_entry(path, cache_dir), mmap_mode='r') for path in cached}
+            if missing:
+                columns, counts = read_pliq_files(missing)
+                parsed = to_records(columns)
+                for path, end, count in zip(missing, np.cumsum(counts), counts):
+                    records[path] = parsed[end - count:end]
+                    if cache_dir is not None:
+                        np.save(cache_entry(path, cache_dir), records[path])
+            if files:
+                parts.append(np.concatenate([records[path] for path in files]))
+        for part in parts:
+            yield batch, {name: part[name] for name in part.dtype.names}
+
+def concatenate_columns(parts):
+    parts = list(parts)
+    if not parts:
+        return {}
+    return {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+
+def load_pliq_directory(directory, kind='csv', cache_dir=None):
+    # kind='csv' loads the full settlement files, kind='txt' the H files
+    return concatenate_columns(columns for paths, columns in iter_pliq_directory(directory, f'*_PLIQ_*.{kind}', cache_dir))
+
+def attach_tenor_data(h_columns, csv_columns, names=('Tasa de Interes', 'Plazo a Vencimiento', 'Futuro')):
+    # The H files only carry strike, series, price and volatility. Rate, tenor and future (and any other
+    # column of names) are the same for every strike of a (date, series) pair, so they are looked up from
+    # the settlement CSV of the same day.
+    def keys(columns):
+        return columns['Fecha'].astype('int64') * 128 + np.asarray(columns['Vencimiento'], dtype='U1').view(np.int32)
+    csv_keys, first = np.unique(keys(csv_columns), return_index=True)
+    h_keys = keys(h_columns)
+    position = np.clip(np.searchsorted(csv_keys, h_keys), 0, len(csv_keys) - 1)
+    found = csv_keys[position] == h_keys
+    if not found.all():
+        raise ValueError('Faltan tasa, plazo o futuro para algunas series del archivo H')
+    rows = first[position]
+    columns = dict(h_columns)
+    for name in names:
+        columns[name] = np.asarray(csv_columns[name])[rows]
+    columns['Bid'] = columns['Ask'] = np.full(len(rows), np.nan)
+    return columns
+
+def add_h_strikes(csv_columns, h_columns):
+    # Settlement CSV quotes plus the H-file quotes of strikes the CSV does not list. H prices are rounded
+    # to whole index points, so they never replace a CSV price; the rows added take the series data of the
+    # CSV and leave its bid/ask and theoretical value empty.
+    def quote_keys(columns):
+        return pd.MultiIndex.from_arrays([columns['Fecha'], columns['Emisora'], columns['Vencimiento'], columns['Serie']])
+    missing = ~quote_keys(h_columns).isin(quote_keys(csv_columns))
+    if not missing.any():
+        return csv_columns
+    added = attach_tenor_data({name: values[missing] for name, values in h_columns.items()}, csv_columns,
+                              ('TV', 'Tasa de Interes', 'Plazo a Vencimiento', 'Futuro', 'Call o Put'))
+    added['Hubo Bid/Ask'] = np.zeros(missing.sum(), dtype='int8')
+    added['V. Teorico'] = np.full(missing.sum(), np.nan)
+    return concatenate_columns([csv_columns, {name: added[name] for name in csv_columns}])
+
+def continuous_rates(rates, days):
+    # 'Tasa de Interes' is a simple ACT/360 rate: discounting with 1 / (1 + rate * days / 360) reproduces
+    # the files' 'V. Teorico' (Black-76 on the future). Every other rate of the package is continuously
+    # compounded on Actual/365, so this is the one place the PLIQ rates are converted.
+    days = np.asarray(days, dtype=float)
+    return np.log1p(np.asarray(rates, dtype=float) * days / 360.0) * 365.0 / np.maximum(days, 1.0)
+
+def pliq_option_frame(columns, call_or_put, date=None):
+    # Adapter to the layout HestonImpliedVolatility.opt_type builds, so PLIQ files can replace yfinance in
+    # get_results. The underlying is the index future: the spot is the future discounted at the tenor rate
+    # (see continuous_rates, no dividend yield) and TTM follows the Actual/365 convention used elsewhere.
+    # PLIQ files carry no traded volume, so every quote gets a volume of one.
+    dates = columns['Fecha']
+    date = dates.max() if date is None else np.datetime64(pd.to_datetime(date).date(), 'D')
+    codes = columns['Vencimiento']
+    calls = np.isin(codes, SERIES_CALLS)
+    mask = (dates == date) & (calls if call_or_put == 'Call' else ~calls)
+    days = np.rint(columns['Plazo a Vencimiento'][mask] * 360).astype('timedelta64[D]')
+    trade_dates = dates[mask]
+    maturities = trade_dates + days
+    ttm = days.astype('int64') / 365.0
+    rates = continuous_rates(columns['Tasa de Interes'][mask], days.astype('int64'))
+    option = pd.DataFrame({
+        'strike': columns['Serie'][mask],
+        'lastPrice': columns['Pliq'][mask],
+        'bid': columns['Bid'][mask],
+        'ask': columns['Ask'][mask],
+        'volume': np.ones(mask.sum()),
+        'impliedVolatility': columns['Volatilidad'][mask],
+        'Maturity': pd.to_datetime(maturities),
+        'lastTradeDate': pd.to_datetime(trade_dates),
+        'TTM': ttm,
+        'Price': columns['Futuro'][mask] * np.exp(-rates * ttm),
+        'Rate': rates
+    })
+    return option
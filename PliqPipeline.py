@@ -0,0 +1,258 @@
+from concurrent.futures import ThreadPoolExecutor
+from VolatilitySurface import VolatilitySurface
+from ResultStore import CalibrationResults
+import VolatilityFunctions as vol
+import PricesFunctions as pr
+import MarketEnvironment
+import BlackScholes as bs
+import PliqLoader
+import pandas as pd
+import numpy as np
+import argparse
+import hashlib
+import json
+import time
+import glob
+import sys
+import os
+
+# Long-running recalibration of a directory where a YYYYMMDD_PLIQ_*.csv / .txt settlement file is
+# dropped every trading day.
+#
+#   python PliqPipeline.py Data --output pipeline --interval 60
+#
+# Every step only reads the files that are new or changed since the last one (size, modification time
+# and content hash), and of their quotes only the maturity slices whose quotes changed are
+# recalibrated (one joint fit per slice, seeded with that slice's previous parameters). The unchanged
+# slices carry their parameters forward and are only repriced. Results go to the Parquet history
+# (ResultStore), the surface of every (underlying, option type) is rebuilt and saved, and one latency
+# report per update is appended to latency.jsonl. The state is rewritten atomically after each trade
+# date and the history partitions of a date are written as the run of that date, replaced when it is
+# processed again, so a restart just picks up the files that were not finished.
+
+OPTION_TYPES = ['Call', 'Put']
+
+def file_digest(path):
+    with open(path, 'rb') as file:
+        return hashlib.sha1(file.read()).hexdigest()
+
+def slice_fingerprint(quotes):
+    # Quotes of one maturity as the file states them: strikes, prices, rate and future. The spot is not
+    # used, it moves every day with the tenor even when the file repeats the same quotes.
+    future = np.round(quotes['Price'].values * np.exp(quotes['Rate'].values * quotes['TTM'].values), 6)
+    values = np.column_stack([quotes[['strike', 'lastPrice', 'Rate']].to_numpy(dtype=float), future])
+    return hashlib.sha1(values.tobytes()).hexdigest()
+
+def slice_key(ticker, option_type, maturity):
+    return f'{ticker}|{option_type}|{pd.Timestamp(maturity).strftime("%Y-%m-%d")}'
+
+class PliqPipeline():
+    def __init__(self, directory, output_dir, pattern='*_PLIQ_*', pricer='array', surface_method='svi', workers=None, on_update=None):
+        # on_update(report, surface) is called after every (underlying, option type) of a trade date
+        self.directory = directory
+        self.output_dir = output_dir
+        self.pattern = pattern
+        self.pricer = pricer
+        self.surface_method = surface_method
+        self.workers = workers
+        self.on_update = on_update
+        self.state_path = os.path.join(output_dir, 'pipeline_state.json')
+        self.history_path = os.path.join(output_dir, 'history')
+        self.report_path = os.path.join(output_dir, 'latency.jsonl')
+        self.surfaces = {}
+        os.makedirs(output_dir, exist_ok=True)
+        self.state = self.load_state()
+
+    def load_state(self):
+        if not os.path.exists(self.state_path):
+            return {'files': {}, 'slices': {}}
+        with open(self.state_path) as file:
+            return json.load(file)
+
+    def save_state(self):
+        # Written to a temporary file and renamed, so a crash never leaves a half-written state
+        temporary = self.state_path + '.tmp'
+        with open(temporary, 'w') as file:
+            json.dump(self.state, file)
+        os.replace(temporary, self.state_path)
+
+    def pending_files(self):
+        # New or changed files, grouped by trade date in date order. A file whose size or modification time
+        # changed but whose content did not is only re-stamped.
+        pending = {}
+        for path in sorted(glob.glob(os.path.join(self.directory, self.pattern))):
+            if not path.endswith(('.csv', '.txt')):
+                continue
+            name, stat = os.path.basename(path), os.stat(path)
+            known = self.state['files'].get(name)
+            if known is not None and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+                continue
+            digest = file_digest(path)
+            if known is not None and known['digest'] == digest:
+                known.update({'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns})
+                continue
+            pending.setdefault(str(PliqLoader.pliq_date(path)), []).append((path, {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'digest': digest}))
+        return dict(sorted(pending.items()))
+
+    def date_columns(self, date):
+        # Quotes of one trade date: the settlement CSV, plus the strikes only an H file of the date lists
+        # (its prices are rounded to whole points, so the CSV price is used wherever there is one). None
+        # until the CSV of the date has arrived.
+        stamp = date.replace('-', '')
+        csv_paths = sorted(glob.glob(os.path.join(self.directory, f'{stamp}_PLIQ_*.csv')))
+        if not csv_paths:
+            return None
+        csv_columns = PliqLoader.read_pliq_files(csv_paths)[0]
+        h_paths = sorted(glob.glob(os.path.join(self.directory, f'{stamp}_PLIQ_*.txt')))
+        if h_paths:
+            return PliqLoader.add_h_strikes(csv_columns, PliqLoader.read_pliq_files(h_paths)[0])
+        return csv_columns
+
+    def seed(self, ticker, option_type, maturity, quotes):
+        # Parameters of the same slice on its last trade date, else of the nearest maturity of the same
+        # underlying and option type, else the cold-start guess
+        entry = self.state['slices'].get(slice_key(ticker, option_type, maturity))
+        if entry is not None and entry['params'] is not None:
+            return entry['params']
+        prefix = f'{ticker}|{option_type}|'
+        candidates = [(abs((pd.Timestamp(key[len(prefix):]) - pd.Timestamp(maturity)).days), entry['params'])
+                      for key, entry in self.state['slices'].items() if key.startswith(prefix) and entry['params'] is not None]
+        if candidates:
+            return min(candidates, key=lambda candidate: candidate[0])[1]
+        return [.1, .1, float(quotes['impliedVolatility'].mean()), .1, .1]
+
+    def calibrate_slice(self, quotes, call_option, initial_params):
+        # Warm starts keep the bounds of a cold start around the slice's implied volatility
+        fitted = vol.HestonSurfaceParametersVolatility(quotes['Price'].values, quotes['strike'].values, quotes['lastPrice'].values, 0.0,
+                                                       initial_params, quotes['Maturity'].values, quotes['TTM'].values,
+                                                       risk_free_rate=quotes['Rate'].values, call_option=call_option, pricer=self.pricer,
+                                                       bounds=vol.heston_bounds(float(quotes['impliedVolatility'].mean())))
+        return CalibrationResults.from_frame(fitted)
+
+    def carry_slice(self, quotes, call_option, params):
+        # Unchanged quotes keep their parameters; only the prices move with the new TTM
+        estimated = pr.HestonNPVArray(*params, quotes['Rate'].values, 0.0, quotes['TTM'].values, quotes['Price'].values,
+                                      quotes['strike'].values, call_option)
+        residuals = estimated - quotes['lastPrice'].values
+        return CalibrationResults(len(quotes)).append(len(quotes), Optimizer='Carried', Success=True, Params=np.tile(params, (len(quotes), 1)),
+                                                      Strike=quotes['strike'].values, TTM=quotes['TTM'].values,
+                                                      Maturity=MarketEnvironment.ql_serials(quotes['Maturity']), Objective_Value=residuals ** 2,
+                                                      Estimated_Price=estimated, Market_Price=quotes['lastPrice'].values, Residual=residuals,
+                                                      MSE=residuals ** 2, Seconds=0.0)
+
+    def process_chain(self, date, ticker, option_type, option):
+        start = time.perf_counter()
+        call_option = option_type == 'Call'
+        groups = list(option.groupby('Maturity', sort=True))
+        fingerprints = {maturity: slice_fingerprint(quotes) for maturity, quotes in groups}
+        entries = {maturity: self.state['slices'].get(slice_key(ticker, option_type, maturity)) for maturity, _ in groups}
+        changed = [(maturity, quotes) for maturity, quotes in groups
+                   if entries[maturity] is None or entries[maturity]['params'] is None or entries[maturity]['fingerprint'] != fingerprints[maturity]]
+        seeds = [self.seed(ticker, option_type, maturity, quotes) for maturity, quotes in changed]
+        calibration_start = time.perf_counter()
+        jobs = [(quotes, call_option, seed) for (maturity, quotes), seed in zip(changed, seeds)]
+        if self.workers is not None and self.workers > 1:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                fitted = list(executor.map(lambda job: self.calibrate_slice(*job), jobs))
+        else:
+            fitted = [self.calibrate_slice(*job) for job in jobs]
+        calibration_seconds = time.perf_counter() - calibration_start
+        fitted = dict(zip([maturity for maturity, _ in changed], fitted))
+
+        stores = []
+        for maturity, quotes in groups:
+            store = fitted[maturity] if maturity in fitted else self.carry_slice(quotes, call_option, entries[maturity]['params'])
+            stores.append(store.set('Date', MarketEnvironment.ql_serials(quotes['lastTradeDate'])))
+            if maturity in fitted:
+                success = store['Success']
+                entry = entries[maturity]
+                # An older file reprocessed later does not overwrite the state of a newer date. A failed fit
+                # leaves the state as it was (previous fingerprint and parameters), so the slice is
+                # calibrated again next time instead of carrying parameters that were never fitted to it
+                if (entry is None or entry['date'] <= date) and success.all():
+                    self.state['slices'][slice_key(ticker, option_type, maturity)] = {
+                        'fingerprint': fingerprints[maturity], 'date': date, 'params': store.params()[0].tolist()}
+        results = CalibrationResults.concat(stores)
+        results.save(self.history_path, ticker, option_type, run=date.replace('-', ''))
+
+        surface_start = time.perf_counter()
+        option = pd.concat([quotes for _, quotes in groups])
+        table = vol.calculate_expected_variance_over_strikes(results)
+        table['Black_Volatility'] = bs.implied_volatility(table['Theorical_Price'].values, option['Price'].values, table['Strike'].values,
+                                                          table['TTM'].values, option['Rate'].values, 0.0, call_option)
+        surface = None
+        try:
+            surface = VolatilitySurface.from_table(table, method=self.surface_method)
+            surface.save(os.path.join(self.output_dir, f'surface_{ticker}_{option_type}_{date}.npz'))
+            self.surfaces[(ticker, option_type)] = surface
+        except Exception as e:
+            print(f'Volatility surface for {ticker} {option_type} {date} could not be built:', e)
+        end = time.perf_counter()
+        report = {'date': date, 'ticker': ticker, 'option_type': option_type, 'quotes': len(option), 'maturities': len(groups),
+                  'recalibrated': len(changed), 'failed': int((~results['Success']).sum()), 'calibration_seconds': calibration_seconds,
+                  'surface_seconds': end - surface_start, 'total_seconds': end - start}
+        return report, surface
+
+    def process_date(self, date, files):
+        start = time.perf_counter()
+        columns = self.date_columns(date)
+        if columns is None:
+            # Wait for the settlement CSV of the date
+            return []
+        parse_seconds = time.perf_counter() - start
+        reports = []
+        for ticker in np.unique(columns['Emisora']):
+            ticker_columns = {name: values[columns['Emisora'] == ticker] for name, values in columns.items()}
+            for option_type in OPTION_TYPES:
+                option = PliqLoader.pliq_option_frame(ticker_columns, option_type, date)
+                if not len(option):
+                    continue
+                report, surface = self.process_chain(date, str(ticker), option_type, option)
+                report.update({'files': [os.path.basename(path) for path, _ in files], 'parse_seconds': parse_seconds})
+                reports.append(report)
+                with open(self.report_path, 'a') as file:
+                    file.write(json.dumps(report) + '\n')
+                if self.on_update is not None:
+                    self.on_update(report, surface)
+        for path, stamp in files:
+            self.state['files'][os.path.basename(path)] = stamp
+        self.save_state()
+        return reports
+
+    def step(self):
+        reports = []
+        for date, files in self.pending_files().items():
+            reports.extend(self.process_date(date, files))
+        self.save_state()
+        return reports
+
+    def run(self, interval=60.0, iterations=None):
+        # Polls the directory every interval seconds; iterations=None runs until interrupted
+        done = 0
+        while iterations is None or done < iterations:
+            started = time.perf_counter()
+            for report in self.step():
+                print(f'{report["date"]} {report["ticker"]} {report["option_type"]}: {report["recalibrated"]}/{report["maturities"]} '
+                      f'vencimientos recalibrados, {report["quotes"]} cotizaciones, {report["total_seconds"]:.2f} s')
+            done += 1
+            if iterations is None or done < iterations:
+                time.sleep(max(interval - (time.perf_counter() - started), 0.0))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Recalibración Heston incremental de un directorio de archivos PLIQ')
+    parser.add_argument('directory')
+    parser.add_argument('--output', default='pipeline')
+    parser.add_argument('--interval', type=float, default=60.0)
+    parser.add_argument('--once', action='store_true')
+    parser.add_argument('--pricer', default='array', choices=list(vol.PRICERS))
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args(argv)
+    pipeline = PliqPipeline(args.directory, args.output, pricer=args.pricer, workers=args.workers)
+    try:
+        pipeline.run(args.interval, 1 if args.once else None)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
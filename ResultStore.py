@@ -0,0 +1,197 @@
+import MarketEnvironment
+import pyarrow.dataset as ds
+import pyarrow as pa
+import QuantLib as ql
+import pandas as pd
+import numpy as np
+import uuid
+
+# Columnar store of calibration results. Every column is a preallocated typed array (one per Heston
+# parameter, plus prices, residual, optimizer and timing), filled in bulk by whole chunks of quotes,
+# so no per-quote DataFrame is built and the parameters never go through an object column. Dates are
+# QuantLib serial numbers. Results are persisted as Parquet partitioned by ticker, trade date, option
+# type and calibration run (root/Ticker=.../Date=YYYY-MM-DD/Type=Call/Run=.../part-*.parquet) and read
+# back lazily, only the partitions and columns asked for. Every run adds its own partitions, so a run
+# holding only some of the quotes of a trade date never removes what earlier runs stored for it.
+
+PARAMETER_NAMES = ['v0', 'kappa', 'theta', 'sigma', 'rho']
+COLUMN_TYPES = {'Strike': np.float64, 'TTM': np.float64, 'Maturity': np.int64, 'Date': np.int64,
+                'v0': np.float64, 'kappa': np.float64, 'theta': np.float64, 'sigma': np.float64, 'rho': np.float64,
+                'Objective_Value': np.float64, 'Estimated_Price': np.float64, 'Market_Price': np.float64,
+                'Residual': np.float64, 'MSE': np.float64, 'Seconds': np.float64, 'Success': np.bool_, 'Optimizer': object}
+PARTITIONING = ds.partitioning(pa.schema([('Ticker', pa.string()), ('Date', pa.string()), ('Type', pa.string()), ('Run', pa.string())]),
+                               flavor='hive')
+
+def run_id():
+    # Sorts in the order the runs were made
+    return pd.Timestamp.now().strftime('%Y%m%dT%H%M%S%f')
+
+def empty_column(name, size):
+    dtype = COLUMN_TYPES[name]
+    if dtype is object:
+        return np.full(size, 'None', dtype=object)
+    if dtype is np.bool_:
+        return np.zeros(size, dtype=bool)
+    if dtype is np.int64:
+        return np.zeros(size, dtype=np.int64)
+    return np.full(size, np.nan)
+
+def as_column(name, values):
+    # None (failed calibrations) becomes NaN in the float columns
+    if COLUMN_TYPES[name] is np.float64:
+        return np.array([np.nan if value is None else value for value in values], dtype=float) if isinstance(values, list) \
+            else np.asarray(values, dtype=float)
+    return np.asarray(values, dtype=COLUMN_TYPES[name])
+
+def to_serials(dates):
+    dates = list(dates) if not isinstance(dates, np.ndarray) else dates
+    if len(dates) and isinstance(dates[0], ql.Date):
+        return np.array([date.serialNumber() for date in dates], dtype=np.int64)
+    dates = np.asarray(dates)
+    return dates.astype(np.int64) if np.issubdtype(dates.dtype, np.integer) else MarketEnvironment.ql_serials(dates)
+
+def serials_to_datetimes(serials):
+    return pd.to_datetime(MarketEnvironment.QL_EPOCH + np.asarray(serials, dtype=np.int64).astype('timedelta64[D]'))
+
+class CalibrationResults():
+    def __init__(self, capacity: int = 1024):
+        self.size = 0
+        self.columns = {name: empty_column(name, max(capacity, 1)) for name in COLUMN_TYPES}
+
+    def __len__(self):
+        return self.size
+
+    def reserve(self, size):
+        # Capacity doubles, so n appends cost O(n) copies overall
+        capacity = len(self.columns['Strike'])
+        if size <= capacity:
+            return
+        capacity = max(size, 2 * capacity)
+        for name, values in self.columns.items():
+            grown = empty_column(name, capacity)
+            grown[:self.size] = values[:self.size]
+            self.columns[name] = grown
+
+    def append(self, n=None, **columns):
+        # columns are equally long arrays (or scalars, broadcast to n rows); 'Params' may be given as an
+        # (n, 5) array instead of the five parameter columns. Missing columns keep their empty value.
+        if 'Params' in columns:
+            params = np.asarray(columns.pop('Params'), dtype=float).reshape(-1, 5)
+            columns.update({name: params[:, i] for i, name in enumerate(PARAMETER_NAMES)})
+        n = n if n is not None else max((len(values) for values in columns.values() if np.ndim(values)), default=1)
+        self.reserve(self.size + n)
+        rows = slice(self.size, self.size + n)
+        for name, values in columns.items():
+            self.columns[name][rows] = as_column(name, values) if np.ndim(values) else values
+        self.size += n
+        return self
+
+    def append_rows(self, rows):
+        # Result dicts of HestonParametersVolatility (as_frame=False), columns gathered once per chunk
+        if not rows:
+            return self
+        params = np.array([[np.nan] * 5 if row['Params'] is None else row['Params'] for row in rows], dtype=float)
+        columns = {name: [row.get(name) for row in rows] for name in COLUMN_TYPES if name in rows[0] and name not in PARAMETER_NAMES}
+        return self.append(len(rows), Params=params, **columns)
+
+    def extend(self, other):
+        return self.append(len(other), **other.data())
+
+    @classmethod
+    def concat(cls, stores):
+        # One allocation for the total size, one bulk copy per store
+        stores = list(stores)
+        result = cls(sum(len(store) for store in stores))
+        for store in stores:
+            result.extend(store)
+        return result
+
+    @classmethod
+    def from_frame(cls, results_df):
+        # Accepts the DataFrame layout of HestonParametersVolatility (a Params column) or the one of
+        # to_frame (one column per parameter)
+        store = cls(len(results_df))
+        columns = {name: results_df[name].tolist() if COLUMN_TYPES[name] is np.float64 else results_df[name].values
+                   for name in COLUMN_TYPES if name in results_df.columns and name not in ('Maturity', 'Date')}
+        if 'Params' in results_df.columns:
+            columns['Params'] = np.array([[np.nan] * 5 if p is None else p for p in results_df['Params']], dtype=float)
+        for name in ('Maturity', 'Date'):
+            if name in results_df.columns:
+                columns[name] = to_serials(results_df[name].values)
+        return store.append(len(results_df), **columns)
+
+    def data(self):
+        # Views of the filled part of every column
+        return {name: values[:self.size] for name, values in self.columns.items()}
+
+    def __getitem__(self, name):
+        return self.columns[name][:self.size]
+
+    def set(self, name, values):
+        self.columns[name][:self.size] = as_column(name, values) if np.ndim(values) else values
+        return self
+
+    def params(self):
+        return np.column_stack([self[name] for name in PARAMETER_NAMES])
+
+    def take(self, rows):
+        result = CalibrationResults(len(rows))
+        return result.append(len(rows), **{name: values[rows] for name, values in self.data().items()})
+
+    def copy(self):
+        return self.take(np.arange(self.size))
+
+    def to_frame(self, columns=None):
+        # Maturity and Date as timestamps
+        columns = list(COLUMN_TYPES) if columns is None else columns
+        frame = pd.DataFrame({name: self[name] for name in columns})
+        for name in ('Maturity', 'Date'):
+            if name in frame.columns:
+                frame[name] = serials_to_datetimes(frame[name].values)
+        return frame
+
+    def to_arrow(self, ticker, option_type, run):
+        table = pa.Table.from_pandas(self.to_frame([name for name in COLUMN_TYPES if name != 'Date']), preserve_index=False)
+        table = table.set_column(table.schema.get_field_index('Maturity'), 'Maturity', table['Maturity'].cast(pa.date32()))
+        dates = (MarketEnvironment.QL_EPOCH + self['Date'].astype('timedelta64[D]')).astype(str)
+        table = table.append_column('Ticker', pa.array([str(ticker)] * self.size)).append_column('Date', pa.array(dates))
+        table = table.append_column('Type', pa.array([option_type] * self.size))
+        return table.append_column('Run', pa.array([str(run)] * self.size))
+
+    def save(self, root, ticker, option_type='Call', run=None):
+        # One partition per trade date, option type and run (a new one on every call by default). Saving
+        # the same run again, e.g. a pipeline reprocessing a valuation date, replaces only that run's
+        # partitions.
+        run = run_id() if run is None else run
+        ds.write_dataset(self.to_arrow(ticker, option_type, run), root, format='parquet', partitioning=PARTITIONING,
+                         basename_template=f'part-{uuid.uuid4().hex}-{{i}}.parquet', existing_data_behavior='delete_matching')
+        return root
+
+def scan_results(root, columns=None, ticker=None, start=None, end=None, option_type=None):
+    # Only the partitions of ticker (a name or a list) and option_type between the start and end trade
+    # dates are opened, and only the requested columns are read from them
+    dataset = ds.dataset(root, format='parquet', partitioning=PARTITIONING)
+    condition = None
+    if ticker is not None:
+        tickers = [ticker] if isinstance(ticker, str) else list(ticker)
+        condition = ds.field('Ticker').isin(tickers)
+    if option_type is not None:
+        term = ds.field('Type') == option_type
+        condition = term if condition is None else condition & term
+    for bound, compare in ((start, lambda field, value: field >= value), (end, lambda field, value: field <= value)):
+        if bound is not None:
+            term = compare(ds.field('Date'), pd.Timestamp(bound).strftime('%Y-%m-%d'))
+            condition = term if condition is None else condition & term
+    frame = dataset.to_table(columns=columns, filter=condition).to_pandas()
+    if 'Date' in frame.columns:
+        frame['Date'] = pd.to_datetime(frame['Date'])
+    if 'Maturity' in frame.columns:
+        frame['Maturity'] = pd.to_datetime(frame['Maturity'])
+    return frame
+
+def parameter_history(root, ticker, start=None, end=None, columns=PARAMETER_NAMES, option_type='Call'):
+    # Time series of the calibrated parameters of one underlying, one row per trade date, maturity and
+    # strike; a quote calibrated by several runs keeps the result of the latest one
+    frame = scan_results(root, ['Date', 'Maturity', 'Strike', 'Success', 'Run'] + list(columns), ticker, start, end, option_type)
+    frame = frame[frame['Success']].sort_values('Run', kind='stable').drop_duplicates(['Date', 'Maturity', 'Strike'], keep='last')
+    return frame.drop(columns=['Success', 'Run']).sort_values(['Date', 'Maturity', 'Strike']).reset_index(drop=True)
@@ -1,7 +1,10 @@
-from HestonVolatilities import HestonImpliedVolatility
 from HestonPrices import HestonPrice
+from MarketData import MarketDataProvider
 from datetime import datetime
 import streamlit as st
+import CalibrationJobs
+import Sensitivity
+import Graphs
 
 
 # Configurations
@@ -20,30 +23,55 @@ st.subheader('Calculadora de opciones europeas')
 
 selected_asset = st.text_input('Introduzca el ticker','AAPL')
 call_or_put = st.selectbox('Call / Put',['Call','Put'])
+offline = st.toggle('Modo sin conexión (solo datos en caché)')
+
+# One market-data provider per process, so reruns are served from its on-disk cache
+@st.cache_resource
+def market_data(offline):
+    return MarketDataProvider(offline=offline)
+provider = market_data(offline)
+
+# Calibrations run in the background, shared by every session of this process and kept across reruns
+@st.cache_resource
+def calibration_jobs():
+    return CalibrationJobs.JobManager(cache_dir='calibration_cache')
+jobs = calibration_jobs()
 
 
 tab3, tab4= st.tabs(["Volatilidad suavizada", "Precio"])
 with tab3:
+    calibration_modes = {'Por opción': 'quote', 'Por vencimiento': 'maturity', 'Superficie completa': 'surface'}
+    calibration = st.selectbox('Calibración', list(calibration_modes.keys()))
+    key = CalibrationJobs.job_key(selected_asset, call_or_put, calibration_modes[calibration], provider.snapshot(selected_asset))
+    # A job on the data cached now, else the last one for these options (possibly still downloading)
+    job = jobs.get(key) or jobs.latest(selected_asset, call_or_put, calibration_modes[calibration])
     if st.button('Encontrar volatilidad suavizada', use_container_width=True):
-        bar = st.progress(0)
-        HestonVolatility = HestonImpliedVolatility(selected_asset)
-        bar.progress(40)
-        HestonVolatility.get_dividend_yield() 
-        HestonVolatility.get_risk_free()
-        HestonVolatility.opt_type(call_or_put)
-        bar.progress(70)
-        HestonVolatility.get_results()
-        bar.progress(100)
+        job = jobs.submit(key, CalibrationJobs.volatility_job(provider, selected_asset, call_or_put, calibration_modes[calibration]),
+                          refresh=not provider.fresh(selected_asset))
+
+    # Only this fragment is rerun while the job is going; the whole page once it has finished
+    @st.fragment(run_every=1.0)
+    def calibration_progress(job):
+        label = f'{job.stage}: {job.done}/{job.total}' if job.total else job.stage
+        st.progress(job.fraction(), text=label)
+        if job.finished():
+            st.rerun()
 
+    if job is not None and not job.finished():
+        calibration_progress(job)
+    elif job is not None and job.status == 'failed':
+        st.error(f'La calibración falló: {job.error}')
+    elif job is not None:
+        table, surface = job.result['table'], job.result['surface']
         st.subheader('Volatilidad Implícita')
         tab1, tab2= st.tabs(["🧮", " 📈"])
         with tab1:
-            st.dataframe(data=HestonVolatility.table, hide_index=True)
+            st.dataframe(data=table, hide_index=True)
         with tab2:
-            st.plotly_chart(HestonVolatility.volatility_surface(), use_container_width=True)
+            st.plotly_chart(surface.figure() if surface is not None else Graphs.vol_surface(table), use_container_width=True)
 
 with tab4:
-    HestonPrices = HestonPrice(selected_asset)
+    HestonPrices = HestonPrice(selected_asset, provider=provider)
     HestonPrices.get_mkt_data(risk_free_rate=.00525)
     HestonPrices.get_dividend_yield()
     HestonPrices.get_closest_most_common_option(call_or_put)
@@ -74,8 +102,9 @@ with tab4:
         with col5:
             rho = st.number_input(f'$\Rho$', value=None, placeholder=f"Óptimo")
 
+    # Set on every rerun, so the sensitivity analysis below uses the same parameters as the price
+    HestonPrices.parameter_optimizer(v0=v0, kappa=kappa, theta=theta, sigma=epsilon, rho=rho)
     if st.button('Calcular precio', use_container_width=True):   
-        HestonPrices.parameter_optimizer()
         HestonPrices.black_scholes_pricing(call_or_put)
         HestonPrices.calculate_heston_pricing(call_or_put)
         st.write('Precio con Heston:', HestonPrices.heston_price)
@@ -83,5 +112,20 @@ with tab4:
     
     sensibility = st.toggle('Análisis de sensibilidad')
     if sensibility:
+        # One engine per market setup, so its cached grids survive reruns
+        @st.cache_resource
+        def sensitivity_engine(risk_free_rate, dividend_yield, call_option):
+            return Sensitivity.SensitivityEngine(risk_free_rate, dividend_yield, call_option)
+        engine = sensitivity_engine(float(HestonPrices.rf), float(HestonPrices.dividend), call_or_put == 'Call')
         with st.container():
-            st.pyplot(HestonPrices.senibility_analysis(call_or_put) , use_container_width=True)
\ No newline at end of file
+            st.plotly_chart(HestonPrices.senibility_analysis(call_or_put, engine=engine), use_container_width=True)
+            st.dataframe(HestonPrices.sensibility_greeks(call_or_put, engine=engine), hide_index=True)
+            col1, col2 = st.columns(2)
+            with col1:
+                x_param = st.selectbox('Eje X', Sensitivity.GRID_NAMES, index=Sensitivity.GRID_NAMES.index('strike_price'))
+            with col2:
+                y_param = st.selectbox('Eje Y', Sensitivity.GRID_NAMES, index=Sensitivity.GRID_NAMES.index('ttm'))
+            if x_param != y_param:
+                base = HestonPrices.sensibility_base()
+                st.plotly_chart(Graphs.sensibility_heatmap(engine, base, x_param, Graphs.sensibility_range(x_param, base),
+                                                           y_param, Graphs.sensibility_range(y_param, base)), use_container_width=True)
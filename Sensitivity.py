@@ -0,0 +1,103 @@
+from collections import OrderedDict
+import PricesFunctions as pr
+import numpy as np
+import threading
+
+# Inputs a sensitivity grid can span, in the order the pricer takes them
+GRID_NAMES = ['v0', 'kappa', 'theta', 'sigma', 'rho', 'spot_price', 'strike_price', 'ttm']
+
+def grid_arguments(base, axes):
+    # Every axis gets its own dimension, in the order given, so one pricer call fills the whole grid.
+    # Without axes the base values may also be equally long arrays, one entry per contract.
+    arguments = {name: np.asarray(base[name], dtype=float) for name in GRID_NAMES}
+    for dimension, (name, values) in enumerate(axes.items()):
+        shape = [1] * len(axes)
+        shape[dimension] = -1
+        arguments[name] = np.asarray(values, dtype=float).reshape(shape)
+    return arguments
+
+def price_grid(base, axes, risk_free_rate, dividend_yield, call_option=True):
+    # Heston prices on the N-dimensional grid spanned by axes ({name: values}), all other inputs fixed
+    # at base. The result has one dimension per axis.
+    arguments = grid_arguments(base, axes)
+    prices = pr.HestonNPVArray(risk_free_rate=risk_free_rate, dividend_yield=dividend_yield, call_option=call_option, **arguments)
+    return np.broadcast_to(prices, tuple(len(values) for values in axes.values()))
+
+def heston_greeks(base, axes=None, risk_free_rate=0.00525, dividend_yield=0.0, call_option=True, relative_bump=1e-3):
+    # Price, delta, gamma, vega with respect to v0 and theta and the sensitivities to kappa, sigma and rho,
+    # by central differences. Every bumped scenario is stacked on a leading axis and priced in one call,
+    # so the work of all bumps over the whole grid is shared. Inputs keep their own shape on that axis, so
+    # parameters shared by a chain of strikes cost one characteristic function per scenario.
+    axes = {} if axes is None else axes
+    arguments = grid_arguments(base, axes)
+    bumps = greek_bumps(arguments, relative_bump)
+    scenarios = [(None, 0.0)] + [(name, sign) for name in bumps for sign in (1.0, -1.0)]
+    shape = np.broadcast_shapes(*[np.shape(values) for values in arguments.values()])
+    stacked = {}
+    for name in GRID_NAMES:
+        values = [arguments[name] + (sign * bumps[name] if name == bumped else 0.0) for bumped, sign in scenarios]
+        stacked[name] = np.stack([np.reshape(value, (1,) * (len(shape) - np.ndim(value)) + np.shape(value)) for value in values])
+    prices = pr.HestonNPVArray(risk_free_rate=risk_free_rate, dividend_yield=dividend_yield, call_option=call_option, **stacked)
+    prices = np.broadcast_to(prices, (len(scenarios),) + shape)
+    shifted = {name: (prices[1 + 2 * i], prices[2 + 2 * i]) for i, name in enumerate(bumps)}
+    return central_differences(prices[0], shifted, bumps)
+
+def greek_bumps(arguments, relative_bump=1e-3):
+    # Absolute bump of every input heston_greeks differentiates against
+    return {'spot_price': relative_bump * np.abs(arguments['spot_price']), 'v0': relative_bump * np.maximum(arguments['v0'], 1e-2),
+            'theta': relative_bump * np.maximum(arguments['theta'], 1e-2), 'kappa': relative_bump * np.maximum(arguments['kappa'], 1e-1),
+            'sigma': relative_bump * np.maximum(arguments['sigma'], 1e-1), 'rho': np.full_like(np.asarray(arguments['rho'], dtype=float), relative_bump)}
+
+def central_differences(base_price, shifted, bumps):
+    # Greeks from the base price and the (up, down) prices of every bump, whatever engine priced them
+    def central(name):
+        up, down = shifted[name]
+        return (up - down) / (2 * bumps[name])
+
+    spot_up, spot_down = shifted['spot_price']
+    return {'price': base_price,
+            'delta': central('spot_price'),
+            'gamma': (spot_up - 2 * base_price + spot_down) / bumps['spot_price'] ** 2,
+            'vega_v0': central('v0'),
+            'vega_theta': central('theta'),
+            'kappa': central('kappa'),
+            'sigma': central('sigma'),
+            'rho': central('rho')}
+
+class SensitivityEngine():
+    # Headless front end for risk jobs and the Streamlit app: the market inputs are fixed per engine and
+    # the last max_entries grids and greeks are kept, so toggling the UI back and forth does not reprice.
+    def __init__(self, risk_free_rate, dividend_yield, call_option=True, max_entries: int = 64):
+        self.risk_free_rate = risk_free_rate
+        self.dividend_yield = dividend_yield
+        self.call_option = call_option
+        self.max_entries = max_entries
+        self.cache = OrderedDict()
+        # Shared by every session using this engine; grids are computed outside the lock
+        self.lock = threading.Lock()
+
+    def key(self, kind, base, axes):
+        return (kind, tuple(float(base[name]) for name in GRID_NAMES),
+                tuple((name, np.asarray(values, dtype=float).tobytes()) for name, values in axes.items()))
+
+    def cached(self, key, compute):
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        result = compute()
+        with self.lock:
+            self.cache[key] = result
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.max_entries:
+                self.cache.popitem(last=False)
+        return result
+
+    def grid(self, base, axes):
+        return self.cached(self.key('grid', base, axes),
+                           lambda: price_grid(base, axes, self.risk_free_rate, self.dividend_yield, self.call_option))
+
+    def greeks(self, base, axes=None):
+        axes = {} if axes is None else axes
+        return self.cached(self.key('greeks', base, axes),
+                           lambda: heston_greeks(base, axes, self.risk_free_rate, self.dividend_yield, self.call_option))
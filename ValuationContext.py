@@ -0,0 +1,56 @@
+from contextlib import contextmanager
+import MarketEnvironment
+import QuantLib as ql
+import threading
+
+# QuantLib keeps a single, process-wide evaluation date (ql.Settings). Every pricing call of a
+# ValuationContext or HestonCalibrationContext runs under EVALUATION_LOCK with the global date set to
+# the context's own date and restored afterwards, so contexts with different trade dates can be used
+# from many threads, or interleaved, without seeing each other's date. The curves they build have
+# fixed reference dates, so the global date only decides which options have already expired. Each
+# QuantLib call holds the GIL, so objects (and the shared curves they observe) are never touched by
+# two threads at once; a context's own objects must still not be shared between threads.
+
+EVALUATION_LOCK = threading.RLock()
+
+@contextmanager
+def evaluation_date(date):
+    with EVALUATION_LOCK:
+        settings = ql.Settings.instance()
+        previous = settings.evaluationDate
+        if previous != date:
+            settings.evaluationDate = date
+        try:
+            yield
+        finally:
+            if settings.evaluationDate != previous:
+                settings.evaluationDate = previous
+
+def to_ql_date(date):
+    return date if isinstance(date, ql.Date) else MarketEnvironment.ql_dates([date])[0]
+
+class ValuationContext():
+    def __init__(self, calculation_date, environment=None):
+        # calculation_date is a ql.Date or anything pandas parses; curves come from environment
+        # (the shared MarketEnvironment by default)
+        self.calculation_date = to_ql_date(calculation_date)
+        self.environment = MarketEnvironment.default_environment if environment is None else environment
+        self.day_count = ql.Actual365Fixed()
+
+    def flat_curve(self, rate):
+        return self.environment.flat_curve(self.calculation_date, rate)
+
+    def year_fraction(self, maturity_date):
+        return self.day_count.yearFraction(self.calculation_date, to_ql_date(maturity_date))
+
+    def npv(self, instrument):
+        with evaluation_date(self.calculation_date):
+            return instrument.NPV()
+
+    def heston_npv(self, v0, kappa, theta, sigma, rho, risk_free_rate, dividend_yield, maturity_date, spot_price, strike_price, call_option=True):
+        payoff = ql.PlainVanillaPayoff(ql.Option.Call if call_option else ql.Option.Put, strike_price)
+        option = ql.VanillaOption(payoff, ql.EuropeanExercise(to_ql_date(maturity_date)))
+        spot_handle = ql.QuoteHandle(ql.SimpleQuote(spot_price))
+        process = ql.HestonProcess(self.flat_curve(risk_free_rate), self.flat_curve(dividend_yield), spot_handle, v0, kappa, theta, sigma, rho)
+        option.setPricingEngine(ql.AnalyticHestonEngine(ql.HestonModel(process)))
+        return self.npv(option)
@@ -1,24 +1,87 @@
-from scipy.optimize import minimize
-
+from scipy.optimize import minimize, least_squares, OptimizeResult
+from concurrent.futures import ThreadPoolExecutor
+from CalibrationContext import HestonCalibrationContext, valid_heston_params
+import PricesFunctions as pr
+import BlackScholes as bs
+import ResultStore
 import yfinance as yf
 import QuantLib as ql
 import pandas as pd
 import numpy as np
+import threading
+import time
 
-def HestonParametersVolatility(spot_price, strike_price, market_price, dividend_yield, initial_params, calculation_date, maturity_date, ttm, risk_free_rate=0.00525, call_option=True, verbose = False):
-    
-    day_count = ql.Actual365Fixed()
-    calendar = ql.UnitedStates(ql.UnitedStates.NYSE)
+# Fallback chain of HestonParametersVolatility: (method, uses the bounds in the fallback, options)
+OPTIMIZER_CHAIN = [('TNC', True, {'maxfun': 50000}), ('L-BFGS-B', True, {'maxiter': 10000}),
+                   ('SLSQP', True, {'maxiter': 10000}), ('Nelder-Mead', False, {'maxiter': 10000})]
 
-    # Set up the QuantLib environment
-    ql.Settings.instance().evaluationDate = calculation_date
-    if call_option:
-        option_type = ql.Option.Call
-    else:
-        option_type = ql.Option.Put
-    payoff = ql.PlainVanillaPayoff(option_type, strike_price)
-    exercise = ql.EuropeanExercise(maturity_date)
-    european_option = ql.VanillaOption(payoff, exercise)
+class CalibrationBudgetExceeded(Exception):
+    pass
+
+def race_optimizers(make_objective, initial_guess, bounds, target, deadline=None, max_evaluations=None):
+    # Runs every optimizer of OPTIMIZER_CHAIN at once, each in its own thread with its own objective
+    # (make_objective() must not share QuantLib objects between calls), all of them inside the bounds.
+    # The race stops as soon as one optimizer converges or any evaluation gets the objective down to
+    # target, and no optimizer evaluates past the deadline (perf_counter time) or the shared evaluation
+    # budget. Returns the best point seen by any optimizer, its objective value, the optimizer that
+    # found it, whether the race was won, and one stage dict per optimizer.
+    lock = threading.Lock()
+    state = {'stop': False, 'evaluations': 0, 'best': (None, np.inf, 'None'), 'won': False}
+
+    def run(method, options):
+        objective = make_objective()
+        evaluations = [0]
+
+        def guarded(x):
+            if state['stop'] or (deadline is not None and time.perf_counter() > deadline) or \
+               (max_evaluations is not None and state['evaluations'] >= max_evaluations):
+                raise CalibrationBudgetExceeded('Stopped by the race')
+            value = objective(x)
+            value = value if np.isfinite(value) else np.inf
+            with lock:
+                state['evaluations'] += 1
+                evaluations[0] += 1
+                if value < state['best'][1]:
+                    state['best'] = (np.array(x, dtype=float), value, method)
+                if value <= target:
+                    state['stop'] = state['won'] = True
+            return value
+
+        stage_start = time.perf_counter()
+        stage = {'Stage': method, 'Success': False, 'Objective_Value': None}
+        try:
+            result = minimize(guarded, initial_guess, method=method, bounds=bounds, options=options)
+            stage.update({'Success': bool(result.success), 'Objective_Value': float(result.fun), 'Message': str(result.message)})
+            if result.success:
+                with lock:
+                    state['stop'] = state['won'] = True
+                    if result.fun <= state['best'][1]:
+                        state['best'] = (np.array(result.x, dtype=float), float(result.fun), method)
+        except Exception as e:
+            stage['Message'] = str(e)
+        stage.update({'Seconds': time.perf_counter() - stage_start, 'Evaluations': evaluations[0]})
+        return stage
+
+    with ThreadPoolExecutor(max_workers=len(OPTIMIZER_CHAIN)) as executor:
+        stages = list(executor.map(lambda chain: run(chain[0], chain[2]), OPTIMIZER_CHAIN))
+    best_x, best_value, best_method = state['best']
+    return best_x, best_value, best_method, state['won'], stages
+
+def HestonParametersVolatility(spot_price, strike_price, market_price, dividend_yield, initial_params, calculation_date, maturity_date, ttm, risk_free_rate=0.00525, call_option=True, verbose = False, context = None, bounds = None, metrics = None,
+                               strategy = 'fallback', budget_seconds = None, max_evaluations = None, tolerance = 1e-6, as_frame = True):
+    # strategy='fallback' runs the optimizers of OPTIMIZER_CHAIN one after the other until one converges,
+    # strategy='race' runs them concurrently (see race_optimizers) and stops at the first one that
+    # converges or prices within tolerance (relative to the market price). budget_seconds and
+    # max_evaluations cap the wall time and objective evaluations of the whole quote in either mode.
+    # as_frame=False returns the result as a plain dict, for callers that gather many quotes into a
+    # ResultStore.CalibrationResults.
+    if strategy not in ('fallback', 'race'):
+        raise ValueError("strategy debe ser 'fallback' o 'race'")
+    
+    # Set up the QuantLib environment once; a context shared by quotes with the same dates and spot can be passed in.
+    # The context prices at calculation_date, the global QuantLib evaluation date is left alone.
+    if context is None:
+        context = HestonCalibrationContext(calculation_date, maturity_date, spot_price, dividend_yield, risk_free_rate, call_option)
 
     # Initial parameters for the Heston model
     initial_v0 = initial_params[0]
@@ -29,95 +92,232 @@ def HestonParametersVolatility(spot_price, strike_price, market_price, dividend_
 
     # Define the optimization objective function
     def objective_function(params):
-        v0, kappa, theta, sigma, rho = params
-
-        heston_process = ql.HestonProcess(
-            ql.YieldTermStructureHandle(ql.FlatForward(calculation_date, risk_free_rate, day_count)),
-            ql.YieldTermStructureHandle(ql.FlatForward(calculation_date, dividend_yield, day_count)),
-            ql.QuoteHandle(ql.SimpleQuote(spot_price)),
-            v0, kappa, theta, sigma, rho
-        )
-
-        model = ql.HestonModel(heston_process)
-        engine = ql.AnalyticHestonEngine(model)
-        european_option.setPricingEngine(engine)
-
-        model_price = european_option.NPV()
+        # Only the model parameters change between evaluations. Nelder-Mead runs without the bounds, so
+        # points outside the Heston domain get an infinite error instead of a price.
+        if not valid_heston_params(params):
+            return np.inf, np.nan
+        model_price = context.npv(params, strike_price)
         error = (model_price - market_price) ** 2
         return error, model_price
 
     # Bounds for the parameters, excluding theta which is input by the user
-    bounds = [(0.0001, 1.0), (0.0001, 2.0), (initial_theta * 0.5, initial_theta * 1.5), (0.0001, 1.0), (-1, 1)]
+    if bounds is None:
+        bounds = heston_bounds(initial_theta)
 
     # Initial parameter guesses, excluding theta which is input by the user
     initial_guess = [initial_v0, initial_kappa, initial_theta, initial_sigma, initial_rho]
 
+    start = time.perf_counter()
+    deadline = None if budget_seconds is None else start + budget_seconds
+    stages = []
+    result = None
+    success = False
+    optimizer_used = 'None'
+    if strategy == 'race':
+        def make_objective():
+            # Every racing optimizer prices with its own context
+            own = HestonCalibrationContext(calculation_date, maturity_date, spot_price, dividend_yield, risk_free_rate, call_option)
+            return lambda params: (own.npv(params, strike_price) - market_price) ** 2 if valid_heston_params(params) else np.inf
+
+        target = (tolerance * max(abs(market_price), 1e-8)) ** 2
+        best_x, best_value, best_method, success, stages = race_optimizers(make_objective, initial_guess, bounds, target, deadline, max_evaluations)
+        success = success and best_x is not None and valid_heston_params(best_x)
+        if success:
+            result = OptimizeResult(x=best_x, fun=best_value)
+            optimizer_used = best_method
     # Try TNC optimizer first, fall back to L-BFGS-B if it fails, then SLSQP, and finally Nelder-Mead as a last resort
-    try:
-        result = minimize(lambda x: objective_function(x)[0], initial_guess, method='TNC', bounds=bounds, options={'maxfun':50000})
-        success = result.success
-        optimizer_used = 'TNC'
-        assert success, "Failed to find solution"
-    except Exception as e:
-        print('TNC optimizer failed with the following error:', e)
+    used = [0]
+    for method, bounded, options in (OPTIMIZER_CHAIN if strategy == 'fallback' else []):
+        evaluations = [0]
+
+        def stage_objective(x):
+            if (deadline is not None and time.perf_counter() > deadline) or (max_evaluations is not None and used[0] >= max_evaluations):
+                raise CalibrationBudgetExceeded('Calibration budget exhausted')
+            used[0] += 1
+            evaluations[0] += 1
+            return objective_function(x)[0]
+
+        stage_start = time.perf_counter()
+        stage_result = None
+        exhausted = False
         try:
-            result = minimize(lambda x: objective_function(x)[0], initial_guess, method='L-BFGS-B', bounds=bounds, options={'maxiter':10000})
-            success = result.success
-            optimizer_used = 'L-BFGS-B'
+            # Nelder-Mead is run without the bounds, the objective keeps it inside the Heston domain
+            result = stage_result = minimize(stage_objective, initial_guess, method=method, bounds=bounds if bounded else None, options=options)
+            success = result.success and valid_heston_params(result.x)
             assert success, "Failed to find solution"
+            optimizer_used = method
         except Exception as e:
-            print('L-BFGS-B optimizer failed with the following error:', e)
-            try:
-                result = minimize(lambda x: objective_function(x)[0], initial_guess, method='SLSQP', bounds=bounds, options={'maxiter':10000})
-                success = result.success
-                optimizer_used = 'SLSQP'
-                assert success, "Failed to find solution"
-            except Exception as e:
-                print('SLSQP optimizer failed with the following error:', e)
-                try:
-                    # Using Nelder-Mead, so we do not pass the bounds
-                    result = minimize(lambda x: objective_function(x)[0], initial_guess, method='Nelder-Mead', options={'maxiter':10000})
-                    success = result.success
-                    optimizer_used = 'Nelder-Mead'
-                    assert success, "Failed to find solution"
-                except Exception as e:
-                    print('Nelder-Mead optimizer failed with the following error:', e)
-                    success = False
-                    optimizer_used = 'None'
+            print(f'{method} optimizer failed with the following error:', e)
+            success = False
+            exhausted = isinstance(e, CalibrationBudgetExceeded)
+        stages.append({'Stage': method, 'Seconds': time.perf_counter() - stage_start, 'Evaluations': evaluations[0], 'Success': success,
+                       'Objective_Value': None if stage_result is None else float(stage_result.fun),
+                       'Message': None if stage_result is None else str(stage_result.message)})
+        # Once the budget is spent the remaining optimizers are not tried
+        if success or exhausted:
+            break
 
     params = result.x if success else None
     objective_value, estimated_price = objective_function(params) if success else (None, None)
     error = (estimated_price - market_price) if success else None
+    seconds = time.perf_counter() - start
+    if metrics is not None:
+        metrics.record(strike_price, ttm, maturity_date, market_price, optimizer_used, success, error, stages, seconds)
+
+    result = {
+        'Optimizer': optimizer_used,
+        'Success': success,
+        'Params': params,
+        'Strike': strike_price,
+        'TTM': ttm,
+        'Maturity': maturity_date,
+        'Objective_Value': objective_value,
+        'Estimated_Price': estimated_price,
+        'Market_Price': market_price if success else None,
+        'Residual': error,
+        'MSE': error**2 if error is not None else None,
+        'Seconds': seconds
+    }
+    if not as_frame:
+        return result
 
     # Create a DataFrame to store the results
+    results_df = pd.DataFrame({name: [value] for name, value in result.items()})
+
+    return results_df
+
+
+
+def heston_bounds(initial_theta):
+    # rho stays strictly inside (-1, 1), where the Heston model is defined
+    return [(0.0001, 1.0), (0.0001, 2.0), (initial_theta * 0.5, initial_theta * 1.5), (0.0001, 1.0), (-0.999, 0.999)]
+
+def calibration_weights(option, weighting=None, risk_free_rate=0.00525, dividend_yield=0.0):
+    # Residual weights for the joint calibration: None (plain price errors), 'vega' (price errors
+    # divided by Black-Scholes vega, roughly implied-volatility errors), 'spread' (divided by the
+    # bid/ask spread; quotes without a positive spread, like the NaN bid/ask of PLIQ H files, keep a
+    # weight of 1) or 'volume' (scaled by the square root of the relative traded volume)
+    n = len(option)
+    if weighting is None:
+        return np.ones(n)
+    if weighting == 'vega':
+        vega = bs.black_scholes_greeks(option['Price'].values, option['strike'].values, option['TTM'].values,
+                                       risk_free_rate, dividend_yield, option['impliedVolatility'].values)['vega']
+        return 1.0 / np.maximum(vega, 1e-4)
+    if weighting == 'spread':
+        spread = (option['ask'] - option['bid']).values.astype(float)
+        quoted = np.isfinite(spread) & (spread > 0)
+        return np.where(quoted, 1.0 / np.maximum(np.where(quoted, spread, 1.0), 0.01), 1.0)
+    if weighting == 'volume':
+        volume = option['volume'].values.astype(float)
+        return np.sqrt(volume / volume.mean())
+    raise ValueError("weighting debe ser None, 'vega', 'spread' o 'volume'")
+
+# Vectorized pricers a joint calibration can use
+PRICERS = {'array': pr.HestonNPVArray, 'fft': pr.HestonNPVFFT}
+
+def HestonSurfaceParametersVolatility(spot_prices, strike_prices, market_prices, dividend_yield, initial_params, maturity_dates, ttms,
+                                      risk_free_rate=0.00525, call_option=True, weights=None, verbose=False, metrics=None, pricer='array',
+                                      bounds=None):
+    # Fits one (v0, kappa, theta, sigma, rho) set to every quote at once by bounded nonlinear least squares
+    # (trust-region reflective, a Levenberg-Marquardt type method) on the vector of weighted price residuals.
+    # The Jacobian is obtained from a single batched call to the vectorized pricer. pricer='fft' prices each
+    # maturity with one Carr-Madan transform instead of one integral per quote, for dense strike ladders.
+    # bounds default to heston_bounds around the theta of initial_params; warm starts pass the bounds of
+    # their cold start so the seed only moves the starting point.
+    if pricer not in PRICERS:
+        raise ValueError("pricer debe ser 'array' o 'fft'")
+    spot_prices, strike_prices, market_prices, ttms = [np.asarray(a, dtype=float) for a in (spot_prices, strike_prices, market_prices, ttms)]
+    weights = np.ones(len(market_prices)) if weights is None else np.asarray(weights, dtype=float)
+
+    bounds = np.array(heston_bounds(initial_params[2]) if bounds is None else bounds)
+    lower, upper = bounds[:, 0], bounds[:, 1]
+
+    def model_prices(params):
+        params = np.atleast_2d(params)
+        prices = PRICERS[pricer](*[params[:, [i]] for i in range(5)], risk_free_rate=risk_free_rate, dividend_yield=dividend_yield,
+                                 ttm=ttms, spot_price=spot_prices, strike_price=strike_prices, call_option=call_option)
+        return np.nan_to_num(prices, nan=1e6, posinf=1e6, neginf=-1e6)
+
+    def residuals(params):
+        return (model_prices(params)[0] - market_prices) * weights
+
+    def jacobian(params, step=1e-6):
+        # Base point and the five bumped points are priced together
+        bumped = np.vstack([params, params + step * np.eye(5)])
+        prices = model_prices(bumped)
+        return ((prices[1:] - prices[0]) * weights / step).T
+
+    initial_guess = np.clip(initial_params, lower, upper)
+    start = time.perf_counter()
+    result = None
+    try:
+        result = least_squares(residuals, initial_guess, jac=jacobian, bounds=(lower, upper), method='trf')
+        success = result.success
+        optimizer_used = 'TRF'
+    except Exception as e:
+        if verbose:
+            print('Least squares calibration failed with the following error:', e)
+        success = False
+        optimizer_used = 'None'
+
+    n = len(market_prices)
+    if success:
+        params = result.x
+        estimated_prices = model_prices(params)[0]
+        errors = estimated_prices - market_prices
+        objective_values = errors ** 2
+    else:
+        params = None
+        estimated_prices = objective_values = errors = [None] * n
+    seconds = time.perf_counter() - start
+    if metrics is not None:
+        # One record for the whole slice: the fit is joint, so its cost can not be split by quote
+        maturities = {date.ISO() if hasattr(date, 'ISO') else str(date) for date in maturity_dates}
+        stages = [{'Stage': 'TRF', 'Seconds': seconds, 'Evaluations': 0 if result is None else int(result.nfev + (result.njev or 0)),
+                   'Success': success, 'Objective_Value': None if result is None else float(result.cost),
+                   'Message': None if result is None else str(result.message)}]
+        metrics.record(np.nan, np.mean(ttms), maturities.pop() if len(maturities) == 1 else 'Surface', None, optimizer_used, success,
+                       np.sqrt(np.mean(np.square(errors))) if success else None, stages, seconds)
+
+    # One row per quote, in the same layout HestonParametersVolatility returns
     results_df = pd.DataFrame({
-        'Optimizer': [optimizer_used],
-        'Success': [success],
-        'Params': [params],
-        'Strike': [strike_price],
-        'TTM': [ttm],
-        'Maturity': [maturity_date],
-        'Objective_Value': [objective_value],
-        'Estimated_Price': [estimated_price],
-        'Market_Price': [market_price if success else None],
-        'MSE': [error**2 if error is not None else None]
+        'Optimizer': [optimizer_used] * n,
+        'Success': [success] * n,
+        'Params': [params] * n,
+        'Strike': strike_prices,
+        'TTM': ttms,
+        'Maturity': list(maturity_dates),
+        'Objective_Value': objective_values,
+        'Estimated_Price': estimated_prices,
+        'Market_Price': market_prices if success else [None] * n,
+        'Residual': errors,
+        'MSE': objective_values,
+        # The joint fit's time, shared equally by its quotes
+        'Seconds': [seconds / max(n, 1)] * n
     })
 
     return results_df
 
 
-
 def expected_variance(v0, kappa, theta, t):
     return theta + (v0 - theta) * np.exp(-kappa * t)
 
-def calculate_expected_variance_over_strikes(results_df):
-    results_df[['v0', 'kappa', 'theta', 'sigma', 'rho']] = pd.DataFrame(results_df['Params'].tolist(), index=results_df.index)
-    results_df.drop(columns='Params', inplace=True)
-    results_df = results_df.fillna(0)
-    results_df.drop(columns = ['Optimizer','Success','Objective_Value','MSE'], inplace = True)
-    results_df['Expected_Variance'] = results_df.apply(lambda row: expected_variance(row['v0'], row['kappa'], row['theta'], row['TTM']), axis=1)
-    results_df = results_df[['Strike','v0','kappa','theta','sigma','rho','Estimated_Price','Market_Price','TTM','Maturity','Expected_Variance']]
-    results_df = results_df.rename( columns = {'Estimated_Price':'Theorical_Price','Expected_Variance':'Implied_Volatility'} )
+def calculate_expected_variance_over_strikes(results):
+    # results is a ResultStore.CalibrationResults, or a results DataFrame which is converted to one.
+    # Failed calibrations carry no parameters and end up as zeros like the other missing values.
+    if isinstance(results, pd.DataFrame):
+        results = ResultStore.CalibrationResults.from_frame(results)
+    columns = {name: np.nan_to_num(results[name]) for name in ['Strike', 'v0', 'kappa', 'theta', 'sigma', 'rho', 'Estimated_Price', 'Market_Price', 'TTM']}
+    results_df = pd.DataFrame({
+        'Strike': columns['Strike'],
+        **{name: columns[name] for name in ResultStore.PARAMETER_NAMES},
+        'Theorical_Price': columns['Estimated_Price'],
+        'Market_Price': columns['Market_Price'],
+        'TTM': columns['TTM'],
+        'Maturity': ResultStore.serials_to_datetimes(results['Maturity']),
+        'Implied_Volatility': expected_variance(columns['v0'], columns['kappa'], columns['theta'], columns['TTM'])
+    })
     return results_df
 
 def plot_ajusted_poli(options, expected_variance_df):
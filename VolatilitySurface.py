@@ -0,0 +1,146 @@
+from scipy.interpolate import UnivariateSpline
+from scipy.optimize import least_squares
+import PricesFunctions as pr
+import BlackScholes as bs
+import pandas as pd
+import numpy as np
+import Graphs
+
+# Queryable implied-volatility surface. Each maturity slice of a results table is smoothed in total
+# variance w = vol^2 * TTM as a function of log-strike, either with raw SVI
+#     w(k) = a + b * (rho * (k - m) + sqrt((k - m)^2 + s^2))
+# (the forward only shifts m, so log-strikes are used directly) or with a smoothing spline. The
+# smiles are sampled once on a log-strike grid; across maturities the grid is made non-decreasing in
+# total variance (no calendar arbitrage) and interpolated linearly in total variance, so every lookup
+# is two binary searches and a bilinear interpolation.
+
+def svi_total_variance(k, a, b, rho, m, s):
+    return a + b * (rho * (k - m) + np.sqrt((k - m) ** 2 + s ** 2))
+
+def fit_svi(log_strikes, total_variances, ttm):
+    # Bounded least squares on raw SVI. b <= 2 / ttm keeps the wings below Lee's moment bound
+    # b * (1 + |rho|) <= 4 / ttm.
+    k, w = np.asarray(log_strikes, dtype=float), np.asarray(total_variances, dtype=float)
+    span = max(k.max() - k.min(), 1e-3)
+    lower = [-w.max(), 0.0, -0.999, k.min() - span, 1e-4]
+    upper = [w.max(), 2.0 / ttm, 0.999, k.max() + span, 10 * span]
+    initial = np.clip([w.min() / 2, 0.1, -0.3, k[np.argmin(w)], 0.1 * span], lower, upper)
+    result = least_squares(lambda p: svi_total_variance(k, *p) - w, initial, bounds=(lower, upper), method='trf')
+    return result.x
+
+def fit_slice(log_strikes, total_variances, ttm, method='svi'):
+    # Smile of one maturity as a function of log-strike. Slices too small for the chosen fit fall
+    # back to linear interpolation between their points.
+    if method not in ('svi', 'spline'):
+        raise ValueError("method debe ser 'svi' o 'spline'")
+    order = np.argsort(log_strikes)
+    k, w = np.asarray(log_strikes, dtype=float)[order], np.asarray(total_variances, dtype=float)[order]
+    if method == 'svi' and len(k) >= 5:
+        params = fit_svi(k, w, ttm)
+        return lambda x: svi_total_variance(x, *params)
+    if method == 'spline' and len(np.unique(k)) >= 4:
+        k, index = np.unique(k, return_index=True)
+        spline = UnivariateSpline(k, w[index], k=3, s=len(k) * np.var(w) * 1e-2)
+        return lambda x: spline(np.clip(x, k[0], k[-1]))
+    k, index = np.unique(k, return_index=True)
+    return lambda x: np.interp(x, k, w[index])
+
+class VolatilitySurface():
+    def __init__(self, log_strikes, ttms, total_variance):
+        # log_strikes (n_k,) and ttms (n_t,) increasing, total_variance (n_t, n_k) non-decreasing down each column
+        self.log_strikes = np.asarray(log_strikes, dtype=float)
+        self.ttms = np.asarray(ttms, dtype=float)
+        self.total_variance = np.asarray(total_variance, dtype=float)
+        self.cached_figure = None
+
+    @classmethod
+    def from_table(cls, table, column=None, method='svi', points=200, margin=0.1, calculation_date=None):
+        # table is the output of calculate_expected_variance_over_strikes (Strike, TTM, Maturity and a
+        # volatility column). The Black volatility of the Heston prices is used when the table has it.
+        # Quotes are grouped by Maturity, with one TTM per maturity measured from calculation_date (by
+        # default the latest trade date, Maturity - TTM, of the table), so quotes of one expiry traded on
+        # different days stay in one slice. Tables without Maturity are grouped by TTM.
+        column = ('Black_Volatility' if 'Black_Volatility' in table.columns else 'Implied_Volatility') if column is None else column
+        data = pd.DataFrame({'k': np.log(table['Strike'].astype(float)), 'TTM': table['TTM'].astype(float),
+                             'vol': table[column].astype(float)})
+        if 'Maturity' in table.columns:
+            maturities = pd.to_datetime(table['Maturity']).values
+            if calculation_date is None:
+                calculation_date = (maturities - np.round(data['TTM'].values * 365.0).astype('timedelta64[D]')).max()
+            data['TTM'] = (maturities - np.datetime64(pd.Timestamp(calculation_date))) / np.timedelta64(1, 'D') / 365.0
+        data = data[np.isfinite(data['vol']) & (data['vol'] > 0) & (data['TTM'] > 0) & np.isfinite(data['k'])]
+        if not len(data):
+            raise ValueError('La tabla no tiene volatilidades válidas para construir la superficie')
+        span = data['k'].max() - data['k'].min()
+        log_strikes = np.linspace(data['k'].min() - margin * span, data['k'].max() + margin * span, points)
+        ttms, slices = [], []
+        for ttm, quotes in data.groupby('TTM'):
+            smile = fit_slice(quotes['k'].values, quotes['vol'].values ** 2 * ttm, ttm, method)
+            ttms.append(ttm)
+            slices.append(np.maximum(smile(log_strikes), 0.0))
+        # Calendar arbitrage: total variance may not decrease with maturity at any strike
+        total_variance = np.maximum.accumulate(np.array(slices), axis=0)
+        return cls(log_strikes, ttms, total_variance)
+
+    @classmethod
+    def from_heston(cls, params, spot_price, strikes, ttms, risk_free_rate=0.00525, dividend_yield=0.0, grid_size=4096):
+        # Surface of a calibrated parameter set on a strikes x ttms grid: every maturity is priced with one
+        # Carr-Madan transform and inverted to Black volatilities. Points whose price is below the transform's
+        # accuracy (far wings) take the volatility of the nearest valid strike of their slice.
+        strikes, ttms = np.sort(np.asarray(strikes, dtype=float)), np.sort(np.asarray(ttms, dtype=float))
+        prices = pr.HestonNPVFFT(*params, risk_free_rate, dividend_yield, ttms[:, None], spot_price, strikes[None, :], grid_size=grid_size)
+        vols = bs.implied_volatility(prices, spot_price, strikes[None, :], ttms[:, None], risk_free_rate, dividend_yield)
+        log_strikes = np.log(strikes)
+        slices = []
+        for ttm, smile in zip(ttms, vols):
+            valid = np.isfinite(smile) & (smile > 0)
+            if not valid.any():
+                raise ValueError(f'No se pudo invertir ninguna volatilidad para TTM = {ttm}')
+            slices.append(np.interp(log_strikes, log_strikes[valid], smile[valid]) ** 2 * ttm)
+        return cls(log_strikes, ttms, np.maximum.accumulate(np.array(slices), axis=0))
+
+    def total_variance_at(self, strike_price, ttm):
+        # Bilinear in (log-strike, total variance). Strikes outside the grid are clamped; before the first
+        # slice total variance goes linearly to zero and after the last one the volatility stays flat.
+        k, t = np.broadcast_arrays(np.log(np.asarray(strike_price, dtype=float)), np.asarray(ttm, dtype=float))
+        k = np.clip(k, self.log_strikes[0], self.log_strikes[-1])
+        j = np.clip(np.searchsorted(self.log_strikes, k) - 1, 0, len(self.log_strikes) - 2)
+        weight_k = (k - self.log_strikes[j]) / (self.log_strikes[j + 1] - self.log_strikes[j])
+
+        def slice_at(i):
+            return self.total_variance[i, j] * (1 - weight_k) + self.total_variance[i, j + 1] * weight_k
+
+        if len(self.ttms) == 1:
+            return slice_at(np.zeros_like(j)) * t / self.ttms[0]
+        i = np.clip(np.searchsorted(self.ttms, t) - 1, 0, len(self.ttms) - 2)
+        lower, upper = slice_at(i), slice_at(i + 1)
+        weight_t = (t - self.ttms[i]) / (self.ttms[i + 1] - self.ttms[i])
+        inside = lower * (1 - weight_t) + upper * weight_t
+        first, last = slice_at(np.zeros_like(i)), slice_at(np.full_like(i, len(self.ttms) - 1))
+        return np.where(t < self.ttms[0], first * t / self.ttms[0], np.where(t > self.ttms[-1], last * t / self.ttms[-1], inside))
+
+    def volatility(self, strike_price, ttm):
+        ttm = np.asarray(ttm, dtype=float)
+        return np.sqrt(np.maximum(self.total_variance_at(strike_price, ttm), 0.0) / np.maximum(ttm, 1e-12))
+
+    def save(self, path):
+        np.savez_compressed(path, log_strikes=self.log_strikes, ttms=self.ttms, total_variance=self.total_variance)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['log_strikes'], data['ttms'], data['total_variance'])
+
+    def to_frame(self):
+        # Long layout (Strike, TTM, Volatility) of the grid, e.g. to store it as Parquet
+        k, t = np.meshgrid(self.log_strikes, self.ttms)
+        return pd.DataFrame({'Strike': np.exp(k.ravel()), 'TTM': t.ravel(), 'Volatility': np.sqrt(self.total_variance.ravel() / t.ravel())})
+
+    def figure(self, points=60):
+        # Rendered once from the grid and reused on later calls
+        if self.cached_figure is None:
+            strikes = np.exp(np.linspace(self.log_strikes[0], self.log_strikes[-1], points))
+            ttms = np.linspace(self.ttms[0], self.ttms[-1], points) if len(self.ttms) > 1 else self.ttms
+            vols = self.volatility(strikes[None, :], ttms[:, None])
+            self.cached_figure = Graphs.vol_surface_grid(strikes, ttms, vols)
+        return self.cached_figure
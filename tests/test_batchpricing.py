@@ -0,0 +1,12 @@
+import BatchPricing as bp
+import pandas as pd
+import numpy as np
+
+def test_quantlib_engine_greeks_match_array_engine():
+    positions = pd.DataFrame({'ticker': ['A'] * 4, 'strike': [90.0, 100.0, 110.0, 100.0], 'maturity': ['2024-03-15'] * 3 + ['2023-01-01'],
+                              'type': ['Call', 'Put', 'Call', 'Call'], 'quantity': [1] * 4})
+    parameters = pd.DataFrame({'ticker': ['A'], 'v0': [0.04], 'kappa': [1.5], 'theta': [0.05], 'sigma': [0.4], 'rho': [-0.6],
+                               'spot_price': [100.0], 'risk_free_rate': [0.04], 'dividend_yield': [0.01]})
+    array = bp.price_positions(positions, parameters, '2023-09-12', 'array')
+    quantlib = bp.price_positions(positions, parameters, '2023-09-12', 'quantlib')
+    assert np.allclose(quantlib[bp.GREEK_COLUMNS], array[bp.GREEK_COLUMNS], rtol=1e-4, atol=1e-6)
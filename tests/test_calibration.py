@@ -0,0 +1,28 @@
+from HestonVolatilities import HestonImpliedVolatility
+from MarketData import MarketDataProvider
+import VolatilityFunctions as vol
+import PliqLoader
+import pandas as pd
+import numpy as np
+import os
+
+DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Data')
+
+def pliq_calls(n, cache_dir):
+    columns = PliqLoader.read_pliq_files([os.path.join(DATA, '20230912_PLIQ_IP.csv')])[0]
+    volatility = HestonImpliedVolatility('IP', provider=MarketDataProvider(cache_dir, offline=True))
+    volatility.load_pliq(columns, 'Call')
+    volatility.option = volatility.option.iloc[:n]
+    return volatility
+
+def test_successful_quotes_stay_in_heston_domain(tmp_path):
+    volatility = pliq_calls(48, str(tmp_path))
+    volatility.get_results(calibration='quote')
+    params = volatility.results.params()[volatility.results['Success']]
+    assert len(params)
+    assert (params[:, :4] > 0).all()
+    assert (np.abs(params[:, 4]) < 1).all()
+
+def test_spread_weights_without_a_quoted_spread():
+    option = pd.DataFrame({'bid': [1.0, np.nan, 2.0, 3.0], 'ask': [1.5, 2.0, np.nan, 3.0]})
+    assert np.array_equal(vol.calibration_weights(option, 'spread'), [2.0, 1.0, 1.0, 1.0])
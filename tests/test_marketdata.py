@@ -0,0 +1,12 @@
+from MarketData import MarketDataProvider
+import pandas as pd
+import os
+
+def test_offline_spot_price_replays_the_last_cached_day(tmp_path):
+    provider = MarketDataProvider(str(tmp_path / 'cache'), offline=True)
+    assert not os.path.exists(provider.cache_dir)
+    os.makedirs(provider.cache_dir)
+    prices = pd.DataFrame({'Adj Close': [101.0, 102.0]}, index=pd.date_range('2023-09-08', periods=2))
+    prices.to_parquet(provider.cache_path('download', 'AAPL', '2023-09-09', '2023-09-12', None))
+    # Replayed on any later day
+    assert provider.spot_price('AAPL', '2023-10-02') == 101.0
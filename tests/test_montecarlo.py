@@ -0,0 +1,14 @@
+from MonteCarlo import HestonMonteCarlo
+import numpy as np
+
+PARAMS = (0.04, 1.5, 0.04, 0.5, -0.7)
+
+def standard_error(chunk_size, antithetic):
+    return HestonMonteCarlo(PARAMS, 100.0, 100.0, 0.05, 0.0, 1.0, n_paths=40002, steps=20, chunk_size=chunk_size, seed=1,
+                            antithetic=antithetic)['Standard_Error']
+
+def test_antithetic_pairs_with_odd_chunks():
+    # Chunks of 20001 paths pair path j with path 10001 + j, like the even ones
+    plain, even, odd = standard_error(20001, False), standard_error(20000, True), standard_error(20001, True)
+    assert odd < 0.85 * plain
+    assert np.isclose(odd, even, rtol=0.1)
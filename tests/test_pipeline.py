@@ -0,0 +1,46 @@
+from PliqPipeline import PliqPipeline
+import PricesFunctions as pr
+import PliqLoader
+import pandas as pd
+import numpy as np
+import shutil
+import os
+
+def chain(strikes, maturity='2023-12-15', date='2023-09-12'):
+    ttm = (pd.Timestamp(maturity) - pd.Timestamp(date)).days / 365
+    # The same prices and future every day, as in a file that repeats its quotes
+    spot_price = 100.0 * np.exp(-0.05 * ttm)
+    prices = pr.HestonNPVArray(0.04, 1.5, 0.05, 0.4, -0.6, 0.05, 0.0, 0.25, 100.0, np.asarray(strikes, dtype=float), True)
+    return pd.DataFrame({'strike': strikes, 'lastPrice': prices, 'Price': spot_price, 'Rate': 0.05, 'TTM': ttm, 'impliedVolatility': 0.2,
+                         'Maturity': pd.Timestamp(maturity), 'lastTradeDate': pd.Timestamp(date)})
+
+def test_failed_slice_is_calibrated_again(tmp_path):
+    pipeline = PliqPipeline(str(tmp_path), str(tmp_path / 'output'))
+    calibrate = pipeline.calibrate_slice
+
+    def failing(quotes, call_option, initial_params):
+        store = calibrate(quotes, call_option, initial_params)
+        return store.set('Success', False)
+
+    pipeline.process_chain('2023-09-11', 'A', 'Call', chain([90.0, 100.0, 110.0], date='2023-09-11'))
+    pipeline.calibrate_slice = failing
+    pipeline.process_chain('2023-09-12', 'A', 'Call', chain([95.0, 100.0, 105.0]))
+    pipeline.calibrate_slice = calibrate
+    # Same quotes as the failed date: the slice is fitted again, not carried with the parameters of 2023-09-11
+    report, _ = pipeline.process_chain('2023-09-13', 'A', 'Call', chain([95.0, 100.0, 105.0], date='2023-09-13'))
+    assert report['recalibrated'] == 1
+    assert pipeline.state['slices']['A|Call|2023-12-15']['date'] == '2023-09-13'
+
+def test_settlement_prices_are_used_when_an_h_file_exists(tmp_path):
+    data = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Data')
+    for name in ('20230912_PLIQ_IP.csv', '20230912_PLIQ_H_IP.txt'):
+        shutil.copy(os.path.join(data, name), tmp_path)
+    columns = PliqPipeline(str(tmp_path), str(tmp_path / 'output')).date_columns('2023-09-12')
+    csv_columns = PliqLoader.read_pliq_files([os.path.join(data, '20230912_PLIQ_IP.csv')])[0]
+    assert np.array_equal(columns['Pliq'], csv_columns['Pliq'])
+
+def test_warm_start_keeps_the_cold_start_bounds(tmp_path):
+    quotes = chain([90.0, 100.0, 110.0])
+    store = PliqPipeline(str(tmp_path), str(tmp_path / 'output')).calibrate_slice(quotes, True, [0.04, 1.5, 1.0, 0.4, -0.6])
+    # theta of the seed is outside heston_bounds(0.2) = (0.1, 0.3); the fit stays inside them
+    assert 0.1 <= store['theta'][0] <= 0.3
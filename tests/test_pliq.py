@@ -0,0 +1,19 @@
+from scipy.stats import norm
+import PliqLoader
+import numpy as np
+import os
+
+DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Data')
+
+def test_rates_reproduce_the_theoretical_values_of_the_file():
+    columns = PliqLoader.read_pliq_files([os.path.join(DATA, '20230912_PLIQ_IP.csv')])[0]
+    option = PliqLoader.pliq_option_frame(columns, 'Call')
+    # Black-76 on the future, discounted at the converted rate
+    discount = np.exp(-option['Rate'].values * option['TTM'].values)
+    future, strike = option['Price'].values / discount, option['strike'].values
+    deviation = option['impliedVolatility'].values * np.sqrt(option['TTM'].values)
+    d1 = np.log(future / strike) / deviation + 0.5 * deviation
+    prices = discount * (future * norm.cdf(d1) - strike * norm.cdf(d1 - deviation))
+    theoretical = columns['V. Teorico'][np.isin(columns['Vencimiento'], PliqLoader.SERIES_CALLS)]
+    quoted = theoretical > 0
+    assert np.median(np.abs(prices - theoretical)[quoted] / theoretical[quoted]) < 5e-4
@@ -0,0 +1,44 @@
+from MarketData import MarketDataProvider
+from HestonPrices import HestonPrice
+import PricesFunctions as pr
+import QuantLib as ql
+import numpy as np
+
+CALCULATION_DATE = ql.Date(12, 9, 2023)
+
+def quantlib_prices(params, days, spot_price, strikes, call_option=True, risk_free_rate=0.05):
+    return np.array([pr.HestonNPV(*params, risk_free_rate, 0.0, CALCULATION_DATE, CALCULATION_DATE + days, spot_price, strike, call_option)
+                     for strike in strikes])
+
+def test_fft_matches_quantlib_on_random_parameters():
+    rng = np.random.default_rng(0)
+    for _ in range(60):
+        params = [rng.uniform(0.01, 0.6), rng.uniform(0.05, 2.0), rng.uniform(0.01, 0.6), rng.uniform(0.05, 1.0), rng.uniform(-0.95, 0.95)]
+        days = int(rng.integers(7, 1826))
+        strikes = 100.0 * np.exp(np.linspace(-1.0, 1.0, 7) * np.sqrt(max(params[0], params[2]) * days / 365))
+        fft = pr.HestonNPVFFT(*params, 0.05, 0.0, days / 365, 100.0, strikes)
+        assert np.abs(fft - quantlib_prices(params, days, 100.0, strikes)).max() < 1e-6 * 100.0, (params, days)
+
+def test_fft_positive_rho_long_maturity():
+    # Moments of order above one explode here, the transform must not
+    params, strikes = (0.348, 0.386, 0.172, 0.675, 0.83), np.array([2500.0, 10000.0, 25000.0, 50000.0, 100000.0, 250000.0])
+    for call_option in (True, False):
+        fft = pr.HestonNPVFFT(*params, 0.05, 0.0, 1580 / 365, 50000.0, strikes, call_option)
+        assert np.abs(fft - quantlib_prices(params, 1580, 50000.0, strikes, call_option)).max() < 1e-6 * 50000.0
+    fft = pr.HestonNPVFFT(0.04, 0.5, 0.04, 0.9, 0.7, 0.05, 0.0, 1095 / 365, 100.0, 100.0)
+    assert abs(fft - quantlib_prices((0.04, 0.5, 0.04, 0.9, 0.7), 1095, 100.0, [100.0])[0]) < 1e-6 * 100.0
+
+def test_fft_strikes_off_the_grid():
+    # Strikes beyond the grid of a low-variance slice fall back to HestonNPVArray
+    params, strikes = (1e-4, 1e-4, 0.005, 1.0, 0.999), np.array([80.0, 100.0, 120.0])
+    fft = pr.HestonNPVFFT(*params, 0.05, 0.0, 400 / 365, 100.0, strikes)
+    assert np.allclose(fft, pr.HestonNPVArray(*params, 0.05, 0.0, 400 / 365, 100.0, strikes))
+
+def test_greeks_use_the_parameters_of_the_price(tmp_path):
+    option = HestonPrice('X', provider=MarketDataProvider(str(tmp_path), offline=True))
+    option.rf, option.dividend = 0.05, 0.0
+    option.get_prices(100.0, 100.0)
+    option.get_dates('2023-09-12', '2024-03-15')
+    option.parameter_optimizer(v0=0.04, kappa=1.5, theta=0.05, sigma=0.4, rho=-0.6)
+    option.calculate_heston_pricing('Call')
+    assert abs(option.sensibility_greeks('Call')['price'][0] - option.heston_price) < 1e-6
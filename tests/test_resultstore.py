@@ -0,0 +1,25 @@
+from ResultStore import CalibrationResults, scan_results, parameter_history
+import MarketEnvironment
+import numpy as np
+
+def results(strikes, v0):
+    serials = MarketEnvironment.ql_serials(np.array(['2023-09-12'] * len(strikes), dtype='datetime64[D]'))
+    maturity = MarketEnvironment.ql_serials(np.array(['2023-12-15'] * len(strikes), dtype='datetime64[D]'))
+    return CalibrationResults(len(strikes)).append(len(strikes), Strike=np.asarray(strikes, dtype=float), Date=serials, Maturity=maturity,
+                                                   Params=np.tile([v0, 1.5, 0.05, 0.4, -0.6], (len(strikes), 1)), Success=True)
+
+def test_overlapping_runs_keep_every_row(tmp_path):
+    root = str(tmp_path)
+    results([90.0, 100.0, 110.0], 0.04).save(root, 'A', 'Call')
+    # A later run with only some of the quotes of the same trade date
+    results([100.0], 0.05).save(root, 'A', 'Call')
+    assert len(scan_results(root, ticker='A')) == 4
+    history = parameter_history(root, 'A')
+    assert history['Strike'].tolist() == [90.0, 100.0, 110.0]
+    assert history['v0'].tolist() == [0.04, 0.05, 0.04]
+
+def test_saving_a_run_again_replaces_it(tmp_path):
+    root = str(tmp_path)
+    results([90.0, 100.0], 0.04).save(root, 'A', 'Call', run='20230912')
+    results([90.0, 100.0], 0.05).save(root, 'A', 'Call', run='20230912')
+    assert scan_results(root, ticker='A')['v0'].tolist() == [0.05, 0.05]
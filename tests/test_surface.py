@@ -0,0 +1,22 @@
+from VolatilitySurface import VolatilitySurface
+import pandas as pd
+import numpy as np
+
+def smile(strikes, ttm):
+    k = np.log(strikes / 100.0)
+    return 0.2 + 0.1 * k ** 2 - 0.05 * k + 0.02 * ttm
+
+def test_quotes_of_one_expiry_traded_on_different_days_form_one_slice():
+    # yfinance TTMs come from each quote's lastTradeDate, so one expiry carries several of them
+    rows = []
+    for maturity, days in (('2024-03-15', 90), ('2024-06-21', 188)):
+        strikes = np.linspace(80.0, 120.0, 9)
+        lag = np.arange(len(strikes)) % 3
+        ttms = (days + lag) / 365.0
+        rows.append(pd.DataFrame({'Strike': strikes, 'TTM': ttms, 'Maturity': pd.Timestamp(maturity),
+                                  'Black_Volatility': smile(strikes, days / 365.0)}))
+    table = pd.concat(rows, ignore_index=True)
+    surface = VolatilitySurface.from_table(table)
+    assert np.allclose(surface.ttms, [90 / 365.0, 188 / 365.0])
+    strikes = np.array([85.0, 100.0, 115.0])
+    assert np.allclose(surface.volatility(strikes, 90 / 365.0), smile(strikes, 90 / 365.0), atol=1e-3)